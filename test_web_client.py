@@ -55,9 +55,7 @@ def test_add_remove_rdf():
     vs = web_client.Session()
     vs.login()
     #To be sure, data doesn't exist, remove it.
-    with NamedTemporaryFile() as f:
-        g.serialize(destination=f.name, format='n3')
-        vs.remove_rdf(f.name)
+    vs.remove_rdf(g)
 
     with NamedTemporaryFile() as f:
         g.serialize(destination=f.name, format='n3')
@@ -71,10 +69,8 @@ def test_add_remove_rdf():
         assert label == Literal(u'Temporary place')
         break
 
-    #Remove it
-    with NamedTemporaryFile() as f:
-        g.serialize(destination=f.name, format='n3')
-        vs.remove_rdf(f.name)
+    #Remove it, straight from the graph.
+    vs.remove_rdf(g)
 
     #Make sure data isn't there.
     data = get_vivo_data()
@@ -0,0 +1,281 @@
+"""
+Non-blocking client for the VIVO web app and its SPARQL interface.
+
+Every operation returns a Job straight away and runs on a bounded
+pool of threads, so hundreds of uploads, merges and queries can be
+interleaved from one orchestrating thread.  All operations share one
+logged-in web_client.Session, and with it the login cookie and the
+keep-alive connection pool.
+
+    client = AsyncClient()
+    client.login().result()
+    jobs = [client.add_rdf(path) for path in paths]
+    jobs.append(client.select(query))
+    results = client.gather(jobs)
+    client.close()
+
+"""
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+import web_client
+from web_client import Session
+from sparql import VIVOSparql
+
+#logging
+import logging
+_logger = logging.getLogger(__name__)
+
+#Default number of concurrent operations per kind.
+MAX_UPLOADS = 2
+MAX_MERGES = 2
+MAX_QUERIES = 4
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class Job(object):
+    """
+    Handle on an operation submitted to an AsyncClient.
+
+    A job can be cancelled until it starts running.  Once it
+    is running it runs to completion.
+    """
+
+    def __init__(self, name, func, args, kwargs):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.state = 'pending'
+        self.value = None
+        self.error = None
+        self.started = None
+        self.elapsed = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def __repr__(self):
+        return '<Job %s %s>' % (self.name, self.state)
+
+    def run(self):
+        with self.lock:
+            if self.state != 'pending':
+                return
+            self.state = 'running'
+        self.started = time.time()
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+            state = 'done'
+        except Exception, e:
+            _logger.error("%s failed: %s" % (self.name, e))
+            self.error = e
+            state = 'failed'
+        self.elapsed = time.time() - self.started
+        self._finish(state)
+
+    def _finish(self, state):
+        with self.lock:
+            self.state = state
+            callbacks, self.callbacks = self.callbacks, []
+        self.finished.set()
+        for func in callbacks:
+            func(self)
+
+    def cancel(self):
+        """
+        Cancel the job if it has not started.  Returns True
+        when the job will not run.
+        """
+        with self.lock:
+            if self.state == 'cancelled':
+                return True
+            if self.state != 'pending':
+                return False
+        self._finish('cancelled')
+        return True
+
+    def cancelled(self):
+        return self.state == 'cancelled'
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Block until the job finishes or timeout seconds pass.
+        Returns True if the job finished.
+        """
+        self.finished.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        """
+        The job's return value.  Re-raises the job's error and
+        raises JobCancelled if it was cancelled.
+        """
+        if not self.wait(timeout):
+            raise Exception("%s did not finish within %s seconds." % (self.name, timeout))
+        if self.state == 'cancelled':
+            raise JobCancelled(self.name)
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, func):
+        """
+        Call func(job) once the job finishes, fails or is cancelled.
+        """
+        with self.lock:
+            if not self.finished.is_set():
+                self.callbacks.append(func)
+                return
+        func(self)
+
+
+class AsyncClient(object):
+    """
+    Runs web_client.Session and VIVOSparql operations in the
+    background on one shared, logged-in Session.
+
+    Each kind of operation has its own pool so the number of
+    concurrent uploads, merges and queries are capped separately.
+    Admin actions (login, recompute, rebuild, named graphs) run
+    one at a time.
+    """
+
+    def __init__(self, url=None, username=None, password=None,
+                 max_uploads=MAX_UPLOADS, max_merges=MAX_MERGES,
+                 max_queries=MAX_QUERIES, cache=None):
+        self.username = username
+        self.password = password
+        pool_size = max_uploads + max_merges + max_queries + 1
+        self.session = Session(url=url, pool_size=pool_size)
+        self.sparql = VIVOSparql(vweb=self.session, cache=cache)
+        self.pools = {
+            'admin': ThreadPool(1),
+            'upload': ThreadPool(max_uploads),
+            'merge': ThreadPool(max_merges),
+            'query': ThreadPool(max_queries),
+        }
+        self.jobs = []
+        self.lock = threading.Lock()
+
+    def submit(self, kind, name, func, *args, **kwargs):
+        """
+        Queue func on the pool for kind and return its Job.
+        """
+        job = Job(name, func, args, kwargs)
+        with self.lock:
+            self.jobs = [j for j in self.jobs if not j.done()]
+            self.jobs.append(job)
+        self.pools[kind].apply_async(job.run)
+        return job
+
+    def _query(self, method, query, *args):
+        worker = self.sparql.clone()
+        worker.setQuery(query)
+        return getattr(worker, method)(*args)
+
+    def _login(self):
+        self.session.login(self.username, self.password)
+        self.sparql.session = self.session.session
+        return True
+
+    #Session operations.
+    def login(self):
+        return self.submit('admin', 'login', self._login)
+
+    def add_rdf(self, file_path, format='N3'):
+        return self.submit('upload', 'add %s' % file_path,
+                           self.session.add_rdf, file_path, format=format)
+
+    def remove_rdf(self, file_path, format='N3'):
+        return self.submit('upload', 'remove %s' % file_path,
+                           self.session.remove_rdf, file_path, format=format)
+
+    def merge(self, uri1, uri2):
+        return self.submit('merge', 'merge %s %s' % (uri1, uri2),
+                           self.session.merge, uri1, uri2)
+
+    def create_named_graph(self, name):
+        return self.submit('admin', 'create %s' % name,
+                           web_client.created_named_graph, name, session=self.session)
+
+    def clear_named_graph(self, name):
+        return self.submit('admin', 'clear %s' % name,
+                           web_client.clear_named_graph, name, session=self.session)
+
+    def remove_named_graph(self, name):
+        return self.submit('admin', 'remove %s' % name,
+                           web_client.remove_named_graph, name, session=self.session)
+
+    def add_rdf_to_named_graph(self, file_path, model_name, format='N3'):
+        return self.submit('upload', 'add %s to %s' % (file_path, model_name),
+                           web_client.add_rdf_to_named_graph, file_path,
+                           model_name, format=format, session=self.session)
+
+    def recompute_inferences(self, wait=False, **kwargs):
+        """
+        With wait, the job polls until the recompute finishes and
+        its result is the final web_client.JobStatus.  kwargs, e.g.
+        progress and timeout, go to web_client.wait_until_idle.
+        """
+        return self.submit('admin', 'recompute',
+                           web_client.recompute_inferences, None,
+                           session=self.session, wait=wait, **kwargs)
+
+    def rebuild_index(self, wait=False, **kwargs):
+        """
+        As recompute_inferences, for the search index.
+        """
+        return self.submit('admin', 'rebuild',
+                           web_client.rebuild_index, None,
+                           session=self.session, wait=wait, **kwargs)
+
+    #VIVOSparql operations.
+    def select(self, query):
+        return self.submit('query', 'select', self._query, 'queryAndConvert', query)
+
+    def construct(self, query):
+        return self.submit('query', 'construct', self._query, 'results_graph', query)
+
+    def csv(self, query, filename='results.csv'):
+        return self.submit('query', 'csv %s' % filename, self._query_csv, query, filename)
+
+    def _query_csv(self, query, filename):
+        return self.sparql.clone().results_csv(query, filename=filename)
+
+    def gather(self, jobs, timeout=None):
+        """
+        Wait for jobs and return their results in order.  The first
+        error is raised after every job has finished.
+        """
+        for job in jobs:
+            job.wait(timeout)
+        return [job.result(0) for job in jobs]
+
+    def cancel_all(self):
+        """
+        Cancel every job that has not started.  Returns the
+        number cancelled.
+        """
+        with self.lock:
+            jobs = list(self.jobs)
+        return len([job for job in jobs if job.cancel()])
+
+    def close(self):
+        """
+        Cancel pending jobs, wait for running ones and log out.
+        """
+        self.cancel_all()
+        for pool in self.pools.values():
+            pool.close()
+        for pool in self.pools.values():
+            pool.join()
+        if self.session.logged_in:
+            self.session.logout()
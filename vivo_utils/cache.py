@@ -0,0 +1,181 @@
+"""
+On-disk cache for SPARQL results from the VIVO web app.
+
+Results are stored in a SQLite file keyed by the normalized query
+text and result format.  Entries expire after a TTL and the least
+recently used entries are evicted once the cache grows past its
+size limit.  Caches are cleared whenever a web_client.Session in
+this process adds, removes or merges data.
+
+"""
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import weakref
+
+import web_client
+
+#logging
+import logging
+_logger = logging.getLogger(__name__)
+
+#Default seconds an entry stays valid.
+TTL = 60 * 60
+#Default maximum bytes of cached results.
+MAX_SIZE = 100 * 1024 * 1024
+
+#SPARQL string literals, long and short, in either quote.
+QUOTED = re.compile(
+    r'("""(?:[^"\\]|\\.|"(?!""))*"""|\'\'\'(?:[^\'\\]|\\.|\'(?!\'\'))*\'\'\'|'
+    r'"(?:[^"\\\n]|\\.)*"|\'(?:[^\'\\\n]|\\.)*\')',
+    re.DOTALL
+)
+WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_query(query):
+    """
+    Collapse whitespace outside string literals so formatting
+    changes share a cache entry.
+    """
+    parts = QUOTED.split(query)
+    for i in range(0, len(parts), 2):
+        parts[i] = WHITESPACE.sub(u' ', parts[i])
+    return u''.join(parts).strip()
+
+
+class QueryCache(object):
+    """
+    Persistent TTL and LRU cache of query results.
+    """
+
+    def __init__(self, path, ttl=TTL, max_size=MAX_SIZE):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute(
+            """create table if not exists results (
+                key text primary key,
+                value blob,
+                size integer,
+                created real,
+                accessed real
+            )"""
+        )
+        self.db.commit()
+        _open_caches.add(self)
+
+    def key(self, query, format, endpoint=''):
+        text = u'%s\n%s\n%s' % (endpoint, format, normalize_query(query))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def get(self, query, format, endpoint=''):
+        """
+        Cached result for query sent to endpoint, or None.
+        """
+        key = self.key(query, format, endpoint)
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                'select value, created from results where key = ?', (key,)
+            ).fetchone()
+            if (row is not None) and (now - row[1] > self.ttl):
+                self.db.execute('delete from results where key = ?', (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                self.db.commit()
+                return None
+            self.db.execute('update results set accessed = ? where key = ?', (now, key))
+            self.db.commit()
+            self.hits += 1
+        return str(row[0])
+
+    def put(self, query, format, value, endpoint=''):
+        """
+        Store a result string, evicting the least recently used
+        entries beyond max_size.
+        """
+        if len(value) > self.max_size:
+            return
+        key = self.key(query, format, endpoint)
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                'insert or replace into results values (?, ?, ?, ?, ?)',
+                (key, sqlite3.Binary(value), len(value), now, now)
+            )
+            total = self.db.execute('select coalesce(sum(size), 0) from results').fetchone()[0]
+            if total > self.max_size:
+                evict = []
+                for key, size in self.db.execute(
+                        'select key, size from results order by accessed'):
+                    if total <= self.max_size:
+                        break
+                    evict.append((key,))
+                    total -= size
+                self.db.executemany('delete from results where key = ?', evict)
+            self.db.commit()
+
+    def clear(self):
+        """
+        Drop all entries.
+        """
+        with self.lock:
+            self.db.execute('delete from results')
+            self.db.commit()
+        _logger.debug("Cleared SPARQL cache %s." % self.path)
+
+    def close(self):
+        """
+        Close the database.  The cache is no longer cleared on changes.
+        """
+        _open_caches.discard(self)
+        with self.lock:
+            self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def stats(self):
+        """
+        Hit and miss counts plus the current number and size of entries.
+        """
+        with self.lock:
+            entries, size = self.db.execute(
+                'select count(*), coalesce(sum(size), 0) from results'
+            ).fetchone()
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+            'entries': entries,
+            'size': size,
+        }
+
+
+#Caches cleared by clear_caches.  Weak, so a cache that is dropped
+#without being closed can still be collected.
+_open_caches = weakref.WeakSet()
+
+
+def clear_caches():
+    """
+    Drop the entries of every open QueryCache.
+    """
+    for c in list(_open_caches):
+        c.clear()
+
+
+web_client.add_change_listener(clear_caches)
@@ -16,4 +16,8 @@ WHERE
 #By default results will be saved to the current directory as results.csv
 sparql.results_csv(query, filename="/tmp/myresults.csv")
 
+#Results are streamed to disk.  A .gz filename writes gzipped output
+#and filename='-' writes to stdout.
+#sparql.results_csv(query, filename="/tmp/myresults.csv.gz")
+
 sparql.logout()
@@ -4,13 +4,16 @@ Utility for developing listViewConfig queries.
 More details are available at: http://lawlesst.github.io/notebook/vivo-listview.html
 
 """
+from multiprocessing import Pool
 from pprint import pprint
+import json
 import optparse
 import re
+import sys
+import time
 import xml.etree.ElementTree as ET
 
-from rdflib import Graph
-from rdflib.namespace import split_uri
+from rdflib import Graph, URIRef
 
 #logging
 import logging
@@ -19,8 +22,15 @@ _logger = logging.getLogger(__name__)
 #Setup VIVO's SPARQL endpoint
 from sparql import VIVOSparql
 
+#Default number of construct queries sent to VIVO at once.
+WORKERS = 4
+
+#Default number of subjects per construct query in batch mode.
+CHUNK_SIZE = 50
+
 #Regex
 SELECT_QUERIES = re.compile("SELECT DISTINCT\s+(\?.*) WHERE \{", re.DOTALL)
+WHERE_START = re.compile(r"WHERE\s*\{", re.IGNORECASE)
 
 
 def pre_process_listview(listview_file):
@@ -45,11 +55,140 @@ def process_listview_select(tree):
     return (select, field_list)
 
 
+def parse_n3(data):
+    """
+    Parse N3 in a worker process and return it as N-Triples, which
+    is much cheaper to parse again than to pickle triple by triple.
+    """
+    g = Graph()
+    g.parse(data=data, format='n3')
+    return g.serialize(format='nt')
+
+
+def parser_pool(processes=None):
+    """
+    Pool of processes for parse_n3, or None to parse in this process
+    when processes is not more than one.
+    """
+    if processes > 1:
+        return Pool(processes)
+    return None
+
+
+def run_constructs(sparql, queries, workers=WORKERS, pool=None):
+    """
+    Run construct queries concurrently over the logged-in sparql
+    connection and merge the results into one graph.  Responses are
+    parsed in this process, or in pool, see parser_pool, as they
+    arrive.
+    """
+    g = Graph()
+    pending = []
+    for index, results in sparql.query_many(queries, workers=workers, ordered=False):
+        if pool is None:
+            g.parse(data=results, format='n3')
+        else:
+            pending.append(pool.apply_async(parse_n3, (results,)))
+    for result in pending:
+        g.parse(data=result.get(), format='nt')
+    return g
+
+
+def property_term(prop):
+    """
+    Wrap a full property uri in angle brackets.  Prefixed names,
+    e.g. core:authorInAuthorship, are used as is.
+    """
+    if unicode(prop).startswith('http'):
+        return "<{0}>".format(prop)
+    return prop
+
+
+def values_construct(query, subjects, qproperty):
+    """
+    Rewrite a listview construct to cover many subjects with one
+    query by binding ?subject with VALUES at the start of the WHERE
+    clause.
+    """
+    match = WHERE_START.search(query)
+    if match is None:
+        raise Exception("No WHERE clause found in construct:\n%s" % query)
+    values = u"\n    VALUES ?subject { %s }\n" % u' '.join(
+        u'<{0}>'.format(s) for s in subjects)
+    query = query[:match.end()] + values + query[match.end():]
+    return query.replace('?property', qproperty)
+
+
+def read_subjects(path=None, sparql=None, query=None):
+    """
+    Subjects from a file, one uri per line, or from the ?subject
+    variable of a SPARQL SELECT.
+    """
+    if path is not None:
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
+    if query is not None:
+        for row in sparql.iter_select(query):
+            yield row['subject']['value']
+
+
+def evaluate_batch(sparql, root, subjects, qproperty, out=sys.stdout,
+                   chunk_size=CHUNK_SIZE, workers=WORKERS, processes=None):
+    """
+    Evaluate a listview for many subjects.  Constructs are run once
+    per chunk of subjects and the select once per subject.  JSON
+    lines are written to out: one per chunk with the time of its
+    constructs, then one per subject with its rows and select time.
+    """
+    constructs = [c.text for c in root.findall('query-construct')]
+    select_query, field_list = process_listview_select(root)
+    subjects = list(subjects)
+    pool = parser_pool(processes)
+    try:
+        for number, start in enumerate(range(0, len(subjects), chunk_size), 1):
+            chunk = subjects[start:start + chunk_size]
+            begin = time.time()
+            queries = [values_construct(q, chunk, qproperty) for q in constructs]
+            g = run_constructs(sparql, queries, workers=workers, pool=pool)
+            out.write(json.dumps({
+                'chunk': number,
+                'subjects': len(chunk),
+                'chunk_construct_seconds': round(time.time() - begin, 4),
+            }) + '\n')
+            for subject in chunk:
+                begin = time.time()
+                rows = g.query(select_query, initBindings={'subject': URIRef(subject)})
+                results = [
+                    dict((f, unicode(v) if v is not None else None)
+                         for f, v in zip(field_list, row))
+                    for row in rows
+                ]
+                out.write(json.dumps({
+                    'subject': subject,
+                    'chunk': number,
+                    'results': results,
+                    'select_seconds': round(time.time() - begin, 4),
+                }) + '\n')
+            out.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+
 def main():
     p = optparse.OptionParser()
     p.add_option('-s', '--subject', help="Subject for query.")
     p.add_option('-p', '--property', help="Property for query.")
     p.add_option('-m', '--max', help="Maximum number of results to return.")
+    p.add_option('-w', '--workers', type='int', default=WORKERS, help="Construct queries sent to VIVO at once.")
+    p.add_option('--processes', type='int', help="Processes parsing construct results.  By default they are parsed in this process.")
+    p.add_option('--subjects', help="Batch mode.  File of subject uris, one per line.")
+    p.add_option('--subjects-query', help="Batch mode.  File with a SPARQL SELECT returning ?subject.")
+    p.add_option('--chunk-size', type='int', default=CHUNK_SIZE, help="Subjects per construct query in batch mode.")
+    p.add_option('-o', '--output', help="File for batch mode JSON lines.  Defaults to stdout.")
     config, arguments = p.parse_args()
     sparql = VIVOSparql()
     sparql.login()
@@ -57,11 +196,25 @@ def main():
     listview_file = arguments[0]
 
     #Determine if the property has a namespace prefix or not.
-    qproperty = config.property
-    prefix, prop = split_uri(unicode(config.property))
-    if prefix.startswith('http'):
-        #Adjust for full uri for property
-        qproperty = "<{0}>".format(qproperty)
+    qproperty = property_term(config.property)
+
+    if config.subjects or config.subjects_query:
+        subjects_query = None
+        if config.subjects_query:
+            with open(config.subjects_query) as f:
+                subjects_query = f.read()
+        subjects = read_subjects(config.subjects, sparql, subjects_query)
+        root = ET.fromstring(pre_process_listview(listview_file))
+        out = open(config.output, 'w') if config.output else sys.stdout
+        try:
+            evaluate_batch(sparql, root, subjects, qproperty, out=out,
+                           chunk_size=config.chunk_size, workers=config.workers,
+                           processes=config.processes)
+        finally:
+            if config.output:
+                out.close()
+        sparql.logout()
+        return
 
     #'core:authorInAuthorship'
     bindings = {
@@ -69,20 +222,23 @@ def main():
         'property': '{0}'.format(qproperty),
     }
 
-    g = Graph()
-
     list_view_xml = pre_process_listview(listview_file)
 
     root = ET.fromstring(list_view_xml)
     #Parse and execute SPARQL constructs.
+    queries = []
     for construct_query in root.findall('query-construct'):
         query = construct_query.text\
             .replace('?subject', bindings['subject'])\
             .replace('?property', bindings['property'])
         _logger.debug('SPARQL:\n%s' % query)
-        sparql.setQuery(query)
-        results = sparql.queryAndConvert()
-        g.parse(data=results, format='n3')
+        queries.append(query)
+    pool = parser_pool(config.processes)
+    try:
+        g = run_constructs(sparql, queries, workers=config.workers, pool=pool)
+    finally:
+        if pool is not None:
+            pool.terminate()
 
     select_query, field_list = process_listview_select(root)
 
@@ -0,0 +1,156 @@
+"""
+Local ledger of RDF uploaded to VIVO.
+
+Records a hash of the canonicalized content of each file or batch
+posted through web_client.Session, with the VIVO url, target graph
+and upload mode, in a SQLite file.  A Session with a ledger skips
+content whose last recorded upload to the same place used the same
+mode, so a restarted ingest job only sends what had not been loaded.
+
+A record only holds until data is changed the other way: any remove
+through the Session drops the url's add records, any add drops its
+remove records, and a merge drops them all.  Changes made outside
+the Session, e.g. edits in the VIVO UI, are not seen; forget the
+url after those.
+
+"""
+import hashlib
+import sqlite3
+import threading
+import time
+
+from web_client import BULK_MODES, CHUNK_SIZE, LINE_FORMATS
+
+#logging
+import logging
+_logger = logging.getLogger(__name__)
+
+#uploadRDF mode removing statements; every other mode adds.
+REMOVE = BULK_MODES['remove']
+
+
+def lines_hash(lines, format):
+    """
+    Order independent hash of the statements of a line based format:
+    the sum of the digests of each line.  Lines are read one at a
+    time so files of any size can be hashed.
+    """
+    total = 0
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            total += int(hashlib.sha1(line).hexdigest(), 16)
+    digest = hashlib.sha1(format.upper() + '\n')
+    digest.update('%x' % (total % (1 << 160)))
+    return digest.hexdigest()
+
+
+def chunks_hash(chunks, format):
+    """
+    Hash content read in chunks, with line endings normalized.
+    """
+    digest = hashlib.sha1(format.upper() + '\n')
+    pending = ''
+    for chunk in chunks:
+        chunk = pending + chunk
+        #Keep a trailing CR for the next chunk, it may start with LF.
+        pending = chunk[-1:] if chunk.endswith('\r') else ''
+        digest.update(chunk[:len(chunk) - len(pending)].replace('\r\n', '\n'))
+    digest.update(pending)
+    return digest.hexdigest()
+
+
+def canonical_hash(data, format):
+    """
+    Hash RDF content.  Line based formats are hashed as their
+    statements so ordering doesn't matter, see lines_hash.  Other
+    formats are hashed as-is, with line endings normalized.
+    """
+    if format.upper() in LINE_FORMATS:
+        return lines_hash(data.splitlines(), format)
+    return chunks_hash([data], format)
+
+
+class UploadLedger(object):
+    """
+    SQLite record of uploads keyed by content hash, VIVO url and graph.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            """create table if not exists uploads (
+                hash text,
+                url text,
+                graph text,
+                mode text,
+                name text,
+                uploaded real,
+                primary key (hash, url, graph)
+            )"""
+        )
+        self.db.commit()
+
+    def data_hash(self, data, format):
+        return canonical_hash(data, format)
+
+    def file_hash(self, file_path, format):
+        """
+        canonical_hash of a file, read a line or chunk at a time.
+        """
+        with open(file_path, 'rb') as f:
+            if format.upper() in LINE_FORMATS:
+                return lines_hash(f, format)
+            return chunks_hash(iter(lambda: f.read(CHUNK_SIZE), ''), format)
+
+    def seen(self, url, graph, mode, digest):
+        """
+        True if the last upload of this content to url and graph
+        used mode.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'select mode from uploads where hash = ? and url = ? and graph = ?',
+                (digest, url, graph or '')
+            ).fetchone()
+        return (row is not None) and (row[0] == mode)
+
+    def record(self, url, graph, mode, digest, name=None):
+        with self.lock:
+            self.db.execute(
+                'insert or replace into uploads values (?, ?, ?, ?, ?, ?)',
+                (digest, url, graph or '', mode, name, time.time())
+            )
+            self.db.commit()
+
+    def invalidate(self, url, mode):
+        """
+        Drop records an upload with mode may have undone: adds
+        after a remove, removes after an add.
+        """
+        with self.lock:
+            if mode == REMOVE:
+                self.db.execute('delete from uploads where url = ? and mode != ?',
+                                (url, REMOVE))
+            else:
+                self.db.execute('delete from uploads where url = ? and mode = ?',
+                                (url, REMOVE))
+            self.db.commit()
+
+    def forget(self, url=None, graph=None):
+        """
+        Drop the records for a graph at url, everything at url,
+        or all records.  Needed when data is removed other than
+        through a ledgered upload, e.g. a named graph is cleared.
+        """
+        with self.lock:
+            if url is None:
+                self.db.execute('delete from uploads')
+            elif graph is None:
+                self.db.execute('delete from uploads where url = ?', (url,))
+            else:
+                self.db.execute('delete from uploads where url = ? and graph = ?',
+                                (url, graph))
+            self.db.commit()
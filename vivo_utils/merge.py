@@ -0,0 +1,192 @@
+"""
+Batch merging of duplicate VIVO individuals.
+
+Pairs of (uri1, uri2) are merged with the VIVO merge tool, uri2 being
+merged into the primary uri1.  Chains and duplicates are collapsed
+before anything is sent so each secondary is merged once, directly
+into its final primary.
+
+"""
+import csv
+import os
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+
+#logging
+import logging
+_logger = logging.getLogger(__name__)
+
+#Default number of concurrent merge requests.
+WORKERS = 2
+
+
+def read_pairs(path):
+    """
+    Read uri1,uri2 pairs from a CSV file.  A header row
+    and blank rows are skipped.
+    """
+    with open(path, 'rb') as f:
+        for row in csv.reader(f):
+            if len(row) < 2:
+                continue
+            uri1, uri2 = row[0].strip(), row[1].strip()
+            if not uri1.startswith('http'):
+                continue
+            yield (uri1, uri2)
+
+
+def collapse_pairs(pairs):
+    """
+    Collapse (uri1, uri2) pairs into a list of (primary, secondary)
+    merges.  Transitive chains resolve to one canonical primary, the
+    end of the chain.  A secondary paired with two primaries stays
+    with the first and the second primary is merged into it too.
+    Self and duplicate pairs are dropped.
+    """
+    parent = {}
+    order = []
+
+    def find(uri):
+        if uri not in parent:
+            parent[uri] = uri
+            order.append(uri)
+        root = uri
+        while parent[root] != root:
+            root = parent[root]
+        #Path compression.
+        while parent[uri] != root:
+            parent[uri], uri = root, parent[uri]
+        return root
+
+    for uri1, uri2 in pairs:
+        primary = find(uri1)
+        secondary = find(uri2)
+        if primary == secondary:
+            continue
+        if secondary == uri2:
+            parent[secondary] = primary
+        else:
+            #uri2 was already merged into another primary.
+            parent[primary] = secondary
+    return [(find(uri), uri) for uri in order if find(uri) != uri]
+
+
+class Throttle(object):
+    """
+    Spaces out calls from many threads to at most rate per second.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_slot = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def read_merged(checkpoint):
+    """
+    Pairs already merged according to a checkpoint file.
+    """
+    done = set()
+    if (checkpoint is None) or (not os.path.exists(checkpoint)):
+        return done
+    with open(checkpoint) as f:
+        for line in f:
+            parts = line.rstrip('\n').split('\t')
+            if len(parts) == 2:
+                done.add(tuple(parts))
+    return done
+
+
+class MergeReport(object):
+    """
+    Outcome of a batch merge.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.merged = 0
+        self.skipped = 0
+        self.failed = []
+        self.elapsed = 0.0
+
+    def summary(self):
+        return "%d merged, %d already done, %d failed of %d in %.1fs." % (
+            self.merged, self.skipped, len(self.failed), self.total, self.elapsed)
+
+
+def merge_pairs(session, pairs, workers=WORKERS, rate=None, checkpoint=None,
+                progress=None):
+    """
+    Merge (uri1, uri2) pairs with a logged-in web_client.Session.
+
+    Pairs are collapsed with collapse_pairs and sent by a pool of
+    workers threads, throttled to at most rate merges per second.
+    VIVO's merge tool is not transactional, so merges into the same
+    primary are sent one after another by a single worker.
+    Completed merges are appended to the checkpoint file, if given,
+    and skipped when the batch is run again.  progress, if given,
+    is called with (completed, total) after each merge.
+
+    Returns a MergeReport.
+    """
+    if session.logged_in != True:
+        raise Exception("VIVO session not created.  Need to call login.")
+    if session.pool_size < workers:
+        session.set_pool_size(workers)
+    merges = collapse_pairs(pairs)
+    report = MergeReport(len(merges))
+    done = read_merged(checkpoint)
+    todo = [pair for pair in merges if pair not in done]
+    report.skipped = len(merges) - len(todo)
+    groups = OrderedDict()
+    for pair in todo:
+        groups.setdefault(pair[0], []).append(pair)
+    throttle = Throttle(rate)
+    lock = threading.Lock()
+    start = time.time()
+    log = open(checkpoint, 'a') if checkpoint is not None else None
+
+    def work(group):
+        for pair in group:
+            throttle.wait()
+            error = None
+            try:
+                session.merge(*pair)
+            except Exception, e:
+                error = str(e)
+                _logger.error("Merge of %s into %s failed: %s" % (pair[1], pair[0], e))
+            with lock:
+                if error is not None:
+                    report.failed.append((pair, error))
+                else:
+                    report.merged += 1
+                    if log is not None:
+                        log.write('%s\t%s\n' % pair)
+                        log.flush()
+                if progress is not None:
+                    progress(report.skipped + report.merged + len(report.failed),
+                             report.total)
+
+    pool = ThreadPool(workers)
+    try:
+        for _ in pool.imap_unordered(work, groups.values()):
+            pass
+    finally:
+        pool.terminate()
+        if log is not None:
+            log.close()
+    report.elapsed = time.time() - start
+    _logger.info(report.summary())
+    return report
@@ -0,0 +1,326 @@
+"""
+Persistent, indexed local mirror of subsets of VIVO.
+
+Statements fetched from VIVO with VIVOSparql.results_graph are kept
+in a SQLite backed rdflib store, indexed on subject, predicate and
+object, so later runs can query them without fetching or parsing
+anything.  Each subset is stored under a key, a subject, a named
+graph or any CONSTRUCT query, and is refreshed on its own when it
+is older than a given age.
+
+    mirror = Mirror('vivo-mirror.db', sparql)
+    mirror.refresh_subjects(faculty_uris, max_age=24 * 60 * 60)
+    for row in mirror.graph().select(query):
+        ...
+
+"""
+import sqlite3
+import threading
+import time
+
+from rdflib import BNode, Literal, URIRef
+from rdflib.store import Store
+
+from models.vivo import VGraph
+from sync import CHUNK_SIZE, describe_query
+
+#logging
+import logging
+_logger = logging.getLogger(__name__)
+
+#Source key for statements added directly, not from a refresh.
+LOCAL = ''
+
+
+class SQLiteStore(Store):
+    """
+    Minimal rdflib Store keeping triples in SQLite.
+
+    Every triple is tagged with the source key it was loaded under
+    so a subset can be replaced without touching the others.  The
+    store is not context aware; graphs over it see the union of all
+    sources.
+    """
+    context_aware = False
+    formula_aware = False
+    transaction_aware = False
+
+    def __init__(self, path):
+        Store.__init__(self)
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript(
+            """
+            create table if not exists terms (
+                id integer primary key,
+                kind text,
+                value text,
+                datatype text,
+                lang text,
+                unique (kind, value, datatype, lang)
+            );
+            create table if not exists triples (
+                s integer,
+                p integer,
+                o integer,
+                source text,
+                unique (s, p, o, source)
+            );
+            create index if not exists triples_po on triples (p, o);
+            create index if not exists triples_o on triples (o);
+            create index if not exists triples_source on triples (source);
+            create table if not exists sources (
+                key text primary key,
+                refreshed real
+            );
+            create table if not exists namespaces (
+                prefix text primary key,
+                uri text
+            );
+            """
+        )
+        self.db.commit()
+        self.ids = {}
+        self.terms = {}
+
+    #Term encoding.
+    def _key(self, term):
+        if isinstance(term, Literal):
+            return ('L', unicode(term), unicode(term.datatype or ''), term.language or '')
+        if isinstance(term, BNode):
+            return ('B', unicode(term), '', '')
+        return ('U', unicode(term), '', '')
+
+    def _id(self, term, create=False):
+        tid = self.ids.get(term)
+        if tid is not None:
+            return tid
+        key = self._key(term)
+        row = self.db.execute(
+            'select id from terms where kind = ? and value = ? and datatype = ? and lang = ?',
+            key
+        ).fetchone()
+        if row is not None:
+            tid = row[0]
+        elif create:
+            tid = self.db.execute(
+                'insert into terms (kind, value, datatype, lang) values (?, ?, ?, ?)',
+                key
+            ).lastrowid
+        else:
+            return None
+        self.ids[term] = tid
+        return tid
+
+    def _term(self, tid):
+        term = self.terms.get(tid)
+        if term is not None:
+            return term
+        kind, value, datatype, lang = self.db.execute(
+            'select kind, value, datatype, lang from terms where id = ?', (tid,)
+        ).fetchone()
+        if kind == 'L':
+            term = Literal(value, lang=lang or None, datatype=datatype or None)
+        elif kind == 'B':
+            term = BNode(value)
+        else:
+            term = URIRef(value)
+        self.terms[tid] = term
+        return term
+
+    def _where(self, triple):
+        """
+        SQL conditions for a triple pattern.  None if a term of the
+        pattern is not in the store.
+        """
+        clauses = []
+        params = []
+        for column, term in zip(('s', 'p', 'o'), triple):
+            if term is None:
+                continue
+            tid = self._id(term)
+            if tid is None:
+                return None
+            clauses.append('%s = ?' % column)
+            params.append(tid)
+        return (clauses, params)
+
+    #Store interface.
+    def add(self, triple, context=None, quoted=False, source=LOCAL):
+        with self.lock:
+            ids = [self._id(term, create=True) for term in triple]
+            self.db.execute('insert or ignore into triples values (?, ?, ?, ?)',
+                            ids + [source])
+        Store.add(self, triple, context, quoted)
+
+    def addN(self, quads):
+        for s, p, o, c in quads:
+            self.add((s, p, o), c)
+        self.commit()
+
+    def remove(self, triple, context=None):
+        with self.lock:
+            where = self._where(triple)
+            if where is None:
+                return
+            clauses, params = where
+            sql = 'delete from triples'
+            if clauses:
+                sql += ' where ' + ' and '.join(clauses)
+            self.db.execute(sql, params)
+            self.db.commit()
+        Store.remove(self, triple, context)
+
+    def triples(self, triple, context=None):
+        with self.lock:
+            where = self._where(triple)
+            if where is None:
+                return
+            clauses, params = where
+            sql = 'select distinct s, p, o from triples'
+            if clauses:
+                sql += ' where ' + ' and '.join(clauses)
+            rows = self.db.execute(sql, params).fetchall()
+            found = [(self._term(s), self._term(p), self._term(o)) for s, p, o in rows]
+        for t in found:
+            yield t, iter([context])
+
+    def __len__(self, context=None):
+        with self.lock:
+            return self.db.execute(
+                'select count(*) from (select distinct s, p, o from triples)'
+            ).fetchone()[0]
+
+    def contexts(self, triple=None):
+        return iter([])
+
+    def bind(self, prefix, namespace):
+        with self.lock:
+            self.db.execute('insert or replace into namespaces values (?, ?)',
+                            (prefix, unicode(namespace)))
+            self.db.commit()
+
+    def namespace(self, prefix):
+        row = self.db.execute('select uri from namespaces where prefix = ?',
+                              (prefix,)).fetchone()
+        if row is None:
+            return None
+        return URIRef(row[0])
+
+    def prefix(self, namespace):
+        row = self.db.execute('select prefix from namespaces where uri = ?',
+                              (unicode(namespace),)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def namespaces(self):
+        for prefix, uri in self.db.execute('select prefix, uri from namespaces').fetchall():
+            yield prefix, URIRef(uri)
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self, commit_pending_transaction=False):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    #Subsets.
+    def replace_source(self, key, triples):
+        """
+        Replace the statements loaded under key.
+        """
+        with self.lock:
+            self.db.execute('delete from triples where source = ?', (key,))
+            for triple in triples:
+                ids = [self._id(term, create=True) for term in triple]
+                self.db.execute('insert or ignore into triples values (?, ?, ?, ?)',
+                                ids + [key])
+            self.db.execute('insert or replace into sources values (?, ?)',
+                            (key, time.time()))
+            self.db.commit()
+
+    def drop_source(self, key):
+        with self.lock:
+            self.db.execute('delete from triples where source = ?', (key,))
+            self.db.execute('delete from sources where key = ?', (key,))
+            self.db.commit()
+
+    def refreshed(self, key):
+        """
+        Time the subset under key was last loaded, or None.
+        """
+        row = self.db.execute('select refreshed from sources where key = ?',
+                              (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+
+class Mirror(object):
+    """
+    Local mirror of VIVO subsets refreshed through a logged-in
+    sparql.VIVOSparql.
+    """
+
+    def __init__(self, path, sparql=None):
+        self.store = SQLiteStore(path)
+        self.sparql = sparql
+
+    def graph(self):
+        """
+        VGraph over the whole mirror, for select and construct.
+        """
+        return VGraph(store=self.store)
+
+    def stale(self, key, max_age=None):
+        """
+        True if key was never loaded or is older than max_age seconds.
+        A max_age of None always refreshes.
+        """
+        refreshed = self.store.refreshed(key)
+        if (refreshed is None) or (max_age is None):
+            return True
+        return time.time() - refreshed > max_age
+
+    def refresh_construct(self, key, query, max_age=None):
+        """
+        Load the results of a CONSTRUCT or DESCRIBE query under key.
+        Returns True if VIVO was queried.
+        """
+        if not self.stale(key, max_age):
+            return False
+        self.sparql.setQuery(query)
+        g = self.sparql.results_graph()
+        self.store.replace_source(key, g)
+        _logger.debug("Mirrored %d statements for %s." % (len(g), key))
+        return True
+
+    def refresh_graph(self, name, max_age=None):
+        """
+        Mirror the statements in a VIVO named graph.
+        """
+        query = u"CONSTRUCT { ?s ?p ?o } WHERE { GRAPH <%s> { ?s ?p ?o } }" % name
+        return self.refresh_construct(u'graph:%s' % name, query, max_age)
+
+    def refresh_subjects(self, subjects, max_age=None, chunk_size=CHUNK_SIZE):
+        """
+        Mirror the statements about each subject, querying VIVO only
+        for subjects that are stale.  Returns the number refreshed.
+        """
+        todo = [URIRef(s) for s in subjects
+                if self.stale(u'subject:%s' % s, max_age)]
+        for start in range(0, len(todo), chunk_size):
+            chunk = todo[start:start + chunk_size]
+            self.sparql.setQuery(describe_query(chunk, graph=None))
+            g = self.sparql.results_graph()
+            for subject in chunk:
+                self.store.replace_source(u'subject:%s' % subject,
+                                          g.triples((subject, None, None)))
+        return len(todo)
+
+    def close(self):
+        self.store.close()
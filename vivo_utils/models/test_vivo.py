@@ -5,6 +5,7 @@ Test the VIVO data model.
 import nose
 
 import rdflib
+import rdflib.compare
 from . import vivo
 
 import logging
@@ -85,6 +86,71 @@ def test_construct_modify():
     for r in new_data.subjects(predicate=rdflib.RDF.type, object=vivo.FOAF.Person):
         assert vivo.BU['jcarberry'] == r
 
+def test_triple_buffer():
+    v = vivo.VGraph()
+    v.parse(data=raw, format='turtle')
+    v.add((vivo.BU['jcarberry'], vivo.VIVO.overview, rdflib.Literal(u'Line one\n"two" \\ caf\xe9')))
+    buf = vivo.TripleBuffer()
+    buf += v
+    buf += v
+    assert len(buf) == 2 * len(v)
+    assert len(buf.terms) < 3 * len(v)
+    for format in ('nt', 'n3'):
+        g = rdflib.Graph()
+        g.parse(data=buf.serialize(format=format), format=format)
+        assert rdflib.compare.isomorphic(g, v)
+    n3 = buf.serialize(format='n3')
+    assert '@prefix bu: <http://vivo.brown.edu/individual/> .' in n3
+    assert 'bu:jcarberry rdf:type vivo:FacultyMember .' in n3
+
+def test_ntriples_writer():
+    from StringIO import StringIO
+    v = vivo.VGraph()
+    v.parse(data=raw, format='turtle')
+    out = StringIO()
+    writer = vivo.NTriplesWriter(out)
+    assert writer.writerows(v) == len(v)
+    assert ''.join(vivo.iter_ntriples(v)) == out.getvalue()
+    g = rdflib.Graph()
+    g.parse(data=out.getvalue(), format='nt')
+    assert rdflib.compare.isomorphic(g, v)
+
+def test_prepared_queries_cached():
+    q = """
+    select ?firstName
+    where { ?f foaf:firstName ?firstName . }
+    """
+    assert vivo.prepare(q) is vivo.prepare(q)
+    assert vivo.get_template(q, True) is vivo.get_template(q, True)
+    assert vivo.prep_query(q, {'f': 'bu:x'}, add_prefixes=True) == \
+        vivo.rq_prefixes + q.replace('?f ', 'bu:x ')
+    assert vivo.as_term('bu:jcarberry') == vivo.BU['jcarberry']
+    assert vivo.as_term('<http://x.edu/a>') == rdflib.URIRef('http://x.edu/a')
+    assert vivo.as_term('"Josiah"') is None
+
+def test_select_query_with_text_bindings():
+    v = vivo.VGraph()
+    v.parse(data=raw, format='turtle')
+    q = """
+    select ?f
+    where { ?f foaf:firstName ?name . }
+    """
+    rows = list(v.select(q, bind={'name': '"Josiah"'}))
+    assert rows[0].f == vivo.BU['jcarberry']
+
+def test_lru_cache_threads():
+    from multiprocessing.pool import ThreadPool
+    cache = vivo.LRUCache(size=8)
+
+    def work(n):
+        for i in range(500):
+            key = (n * i) % 20
+            if cache.get(key) is None:
+                cache.put(key, i)
+    pool = ThreadPool(8)
+    pool.map(work, range(1, 17))
+    pool.close()
+    assert len(cache.items) == 8
 
 
 if __name__ == '__main__':
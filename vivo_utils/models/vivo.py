@@ -1,14 +1,20 @@
 """
 Helpers for working with VIVO data.
 """
+from array import array
+from collections import OrderedDict
+import re
+from StringIO import StringIO
 import string
+import threading
 import uuid
 
 
 #RDFlib
 import rdflib
-from rdflib import Namespace, ConjunctiveGraph, Graph, URIRef, RDFS
+from rdflib import Namespace, ConjunctiveGraph, Graph, URIRef, BNode, Literal, RDFS
 from rdflib.namespace import NamespaceManager, ClosedNamespace
+from rdflib.plugins.sparql import prepareQuery
 
 #logging
 import logging
@@ -51,6 +57,9 @@ turtle_prefixes = u"\n".join("@prefix %s: <%s> ." % (k.lower(), v)
                          for k, v in namespaces.items())
 #namespace setup complete
 
+#Local names that can be written as prefix:local.
+QNAME_LOCAL = re.compile(r'^[A-Za-z_][A-Za-z0-9_\-]*$')
+
 def init_graph(graph_type=None):
     """
     Helper to initialize a VIVO graph with
@@ -81,17 +90,90 @@ class SPARQLTemplate(string.Template):
     delimiter = '?'
     idpattern = '[a-z]+'
 
+#Number of templates and parsed queries kept by prep_query and prepare.
+QUERY_CACHE_SIZE = 256
+
+
+class LRUCache(object):
+    """
+    Small least recently used cache, safe to share between threads.
+    """
+
+    def __init__(self, size=QUERY_CACHE_SIZE):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = value
+            if len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+_templates = LRUCache()
+_prepared = LRUCache()
+
+
+def get_template(raw, add_prefixes=False):
+    """
+    Compiled SPARQLTemplate for raw, with the prefix block
+    prepended if add_prefixes is True.  Cached.
+    """
+    key = (raw, add_prefixes == True)
+    t = _templates.get(key)
+    if t is None:
+        if add_prefixes == True:
+            t = SPARQLTemplate(rq_prefixes + raw)
+        else:
+            t = SPARQLTemplate(raw)
+        _templates.put(key, t)
+    return t
+
 def prep_query(raw, replace_dict, add_prefixes=False):
-    t = SPARQLTemplate(raw)
-    transformed = t.safe_substitute(replace_dict)
-    if add_prefixes == True:
-        return rq_prefixes + transformed
-    return transformed
+    return get_template(raw, add_prefixes).safe_substitute(replace_dict)
+
+def prepare(raw):
+    """
+    Parsed and translated rdflib query for raw, using the
+    namespace manager's prefixes.  Cached, so looping a query
+    over many bindings parses it once.
+    """
+    q = _prepared.get(raw)
+    if q is None:
+        q = prepareQuery(raw, initNs=dict(ns_mgr.namespaces()))
+        _prepared.put(raw, q)
+    return q
+
+def as_term(value):
+    """
+    rdflib term for a binding value: a term, <uri> or prefix:name.
+    None when the value can only be substituted as text.
+    """
+    if isinstance(value, (URIRef, Literal, BNode)):
+        return value
+    if not isinstance(value, basestring):
+        return None
+    if value.startswith('<') and value.endswith('>'):
+        return URIRef(value[1:-1])
+    prefix, sep, local = value.partition(':')
+    if sep and QNAME_LOCAL.match(local):
+        for p, ns in ns_mgr.namespaces():
+            if p == prefix:
+                return URIRef(ns + local)
+    return None
 
 class VGraph(Graph):
 
-    def __init__(self):
-        Graph.__init__(self, namespace_manager=ns_mgr)
+    def __init__(self, store='default'):
+        Graph.__init__(self, store=store, namespace_manager=ns_mgr)
 
     def construct(self, query, bind={}):
         """
@@ -102,9 +184,7 @@ class VGraph(Graph):
         in the query
         """
         out = init_graph()
-        prepped_query = prep_query(query, bind)
-        logging.debug(prepped_query)
-        results = self.query(prepped_query)
+        results = self._query(query, bind)
         if results.graph is None:
             return
         else:
@@ -118,6 +198,200 @@ class VGraph(Graph):
         Pass in a dictionary bind with values to replace
         in the query.
         """
-        prepped_query = prep_query(query, bind)
-        logging.debug(prepped_query)
-        return self.query(prepped_query)
\ No newline at end of file
+        return self._query(query, bind)
+
+    def _query(self, query, bind):
+        """
+        Run a cached, prepared query with bind as initBindings.
+        Falls back to substituting bind into the query text when
+        a value is not a URI or rdflib term.
+        """
+        bindings = {}
+        for key, value in bind.items():
+            term = as_term(value)
+            if term is None:
+                prepped_query = prep_query(query, bind)
+                logging.debug(prepped_query)
+                return self.query(prepped_query)
+            bindings[key] = term
+        logging.debug(query)
+        return self.query(prepare(query), initBindings=bindings)
+
+
+#Characters escaped in N-Triples literals.
+NT_ESCAPES = {
+    ord(u'\\'): u'\\\\',
+    ord(u'"'): u'\\"',
+    ord(u'\n'): u'\\n',
+    ord(u'\r'): u'\\r',
+}
+
+
+def nt_term(term):
+    """
+    N-Triples form of an rdflib term.  Unlike term.n3(), literals
+    are always written on one line.
+    """
+    if isinstance(term, Literal):
+        text = u'"%s"' % term.translate(NT_ESCAPES)
+        if term.language:
+            return u'%s@%s' % (text, term.language)
+        if term.datatype:
+            return u'%s^^<%s>' % (text, term.datatype)
+        return text
+    if isinstance(term, BNode):
+        return u'_:%s' % term
+    return u'<%s>' % term
+
+
+def iter_ntriples(triples):
+    """
+    Yield each triple as a UTF-8 encoded N-Triples line, e.g. to
+    stream to web_client.Session.add_rdf without a temporary file.
+    """
+    writer = NTriplesWriter(None)
+    for triple in triples:
+        yield writer.line(triple)
+
+
+class NTriplesWriter(object):
+    """
+    Streaming N-Triples writer.  Triples are written to out, any
+    object with a write or sendall method such as a file or socket,
+    as they are produced.  URIs are mostly repeated predicates and
+    classes, so their N-Triples form is cached.
+    """
+
+    def __init__(self, out, cache_size=10000):
+        self.out = out
+        if out is not None:
+            self._write = getattr(out, 'write', None) or out.sendall
+        self.cache = {}
+        self.cache_size = cache_size
+        self.count = 0
+
+    def term(self, term):
+        if not isinstance(term, URIRef):
+            return nt_term(term)
+        text = self.cache.get(term)
+        if text is None:
+            text = u'<%s>' % term
+            if len(self.cache) < self.cache_size:
+                self.cache[term] = text
+        return text
+
+    def line(self, triple):
+        s, p, o = triple
+        return (u'%s %s %s .\n' % (self.term(s), self.term(p), self.term(o))).encode('utf-8')
+
+    def write(self, triple):
+        self._write(self.line(triple))
+        self.count += 1
+
+    def writerows(self, triples):
+        for triple in triples:
+            self.write(triple)
+        return self.count
+
+
+class TripleBuffer(object):
+    """
+    Write-only, append optimized store for building large ingest
+    payloads.  Each distinct term is stored once and triples are
+    kept as three arrays of term ids, so millions of triples take
+    a fraction of the memory of a Graph.  Triples are not indexed
+    or de-duplicated; the buffer is meant to be filled and then
+    serialized for web_client.Session.add_rdf.
+    """
+
+    def __init__(self, namespace_manager=ns_mgr):
+        self.namespace_manager = namespace_manager
+        self.ids = {}
+        self.terms = []
+        self.subjects = array('l')
+        self.predicates = array('l')
+        self.objects = array('l')
+
+    def _intern(self, term):
+        tid = self.ids.get(term)
+        if tid is None:
+            tid = len(self.terms)
+            self.ids[term] = tid
+            self.terms.append(term)
+        return tid
+
+    def add(self, triple):
+        s, p, o = triple
+        self.subjects.append(self._intern(s))
+        self.predicates.append(self._intern(p))
+        self.objects.append(self._intern(o))
+
+    def __iadd__(self, triples):
+        for triple in triples:
+            self.add(triple)
+        return self
+
+    def __len__(self):
+        return len(self.subjects)
+
+    def __iter__(self):
+        terms = self.terms
+        for i in xrange(len(self.subjects)):
+            yield (terms[self.subjects[i]],
+                   terms[self.predicates[i]],
+                   terms[self.objects[i]])
+
+    def _n3_terms(self):
+        """
+        N3 form of every term, abbreviating URIs with the namespace
+        manager's prefixes.  Returns (prefixes used, term strings).
+        """
+        namespaces = sorted(
+            ((unicode(ns), prefix) for prefix, ns in self.namespace_manager.namespaces()
+             if prefix),
+            key=lambda pair: -len(pair[0])
+        )
+        used = {}
+        out = []
+        for term in self.terms:
+            text = None
+            if isinstance(term, URIRef):
+                for ns, prefix in namespaces:
+                    if term.startswith(ns) and QNAME_LOCAL.match(term[len(ns):]):
+                        text = u'%s:%s' % (prefix, term[len(ns):])
+                        used[prefix] = ns
+                        break
+            out.append(text or nt_term(term))
+        return used, out
+
+    def serialize(self, destination=None, format='nt'):
+        """
+        Write the triples as N-Triples ('nt') or N3 ('n3') with the
+        namespace manager's prefixes.  destination is a path or a
+        file-like object; with None the serialization is returned.
+        """
+        if format == 'nt':
+            prefixes, terms = {}, [nt_term(t) for t in self.terms]
+        elif format == 'n3':
+            prefixes, terms = self._n3_terms()
+        else:
+            raise Exception("Unsupported format %s.  Options are nt, n3." % format)
+        if destination is None:
+            out = StringIO()
+        elif hasattr(destination, 'write'):
+            out = destination
+        else:
+            out = open(destination, 'wb')
+        try:
+            for prefix, ns in sorted(prefixes.items()):
+                out.write((u'@prefix %s: <%s> .\n' % (prefix, ns)).encode('utf-8'))
+            for i in xrange(len(self.subjects)):
+                line = u'%s %s %s .\n' % (terms[self.subjects[i]],
+                                           terms[self.predicates[i]],
+                                           terms[self.objects[i]])
+                out.write(line.encode('utf-8'))
+            if destination is None:
+                return out.getvalue()
+        finally:
+            if (destination is not None) and not hasattr(destination, 'write'):
+                out.close()
@@ -0,0 +1,226 @@
+"""
+Parallel ingest for the VIVO web app.
+
+Spreads RDF files, or N-Triples batches cut from a large file, across
+a bounded pool of threads that share one logged-in web_client.Session.
+The number of uploads in flight is capped so VIVO can be kept busy
+without being overloaded.
+
+"""
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from web_client import BATCH_SIZE, BULK_MODES, LINE_FORMATS, \
+    get_name_extension, iter_triple_batches
+
+#logging
+import logging
+_logger = logging.getLogger(__name__)
+
+#Default number of concurrent uploads.
+WORKERS = 4
+
+
+class UploadOutcome(object):
+    """
+    Result of one file or batch upload.
+    """
+
+    def __init__(self, name, size=0, triples=0):
+        self.name = name
+        self.size = size
+        self.triples = triples
+        self.ok = False
+        self.error = None
+        self.seconds = 0.0
+        #web_client.UploadResult with the counts VIVO reported.
+        self.result = None
+
+    @property
+    def statements(self):
+        return getattr(self.result, 'statements', 0)
+
+    def __repr__(self):
+        if self.ok:
+            return '<UploadOutcome %s ok %.2fs>' % (self.name, self.seconds)
+        return '<UploadOutcome %s failed: %s>' % (self.name, self.error)
+
+
+class UploadReport(object):
+    """
+    Per upload outcomes plus throughput for a whole run.
+    """
+
+    def __init__(self):
+        self.outcomes = []
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+
+    @property
+    def succeeded(self):
+        return [o for o in self.outcomes if o.ok]
+
+    @property
+    def failed(self):
+        return [o for o in self.outcomes if not o.ok]
+
+    @property
+    def bytes_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return sum(o.size for o in self.succeeded) / self.elapsed
+
+    @property
+    def triples_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return sum(o.triples for o in self.succeeded) / self.elapsed
+
+    @property
+    def statements_per_second(self):
+        """
+        Statements VIVO reported adding or removing per second.
+        """
+        if not self.elapsed:
+            return 0.0
+        return sum(o.statements for o in self.succeeded) / self.elapsed
+
+    @property
+    def failure_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return float(len(self.failed)) / len(self.outcomes)
+
+    def summary(self):
+        return "%d uploaded, %d failed in %.1fs (%.0f statements/s, %.0f triples/s, %.0f bytes/s)." % (
+            len(self.succeeded),
+            len(self.failed),
+            self.elapsed,
+            self.statements_per_second,
+            self.triples_per_second,
+            self.bytes_per_second
+        )
+
+
+class UploadPool(object):
+    """
+    Bounded pool of upload threads sharing one logged-in Session.
+
+    workers is the maximum number of uploadRDF requests in flight.
+    The session's connection pool is grown to match so every worker
+    keeps its own keep-alive connection.
+    """
+
+    def __init__(self, session, workers=WORKERS):
+        if session.logged_in != True:
+            raise Exception("VIVO session not created.  Need to call login.")
+        self.session = session
+        self.workers = workers
+        if session.pool_size < workers:
+            session.set_pool_size(workers)
+
+    def _run(self, tasks, adaptive=None):
+        """
+        Run (outcome, func) tasks.  A semaphore keeps at most
+        workers tasks queued or running so lazily generated
+        batches are never all held in memory.  With an
+        AdaptiveBatchSize, its current worker limit is used
+        instead and each upload's latency is reported to it.
+        """
+        report = UploadReport()
+        slots = adaptive or threading.BoundedSemaphore(self.workers)
+        lock = threading.Lock()
+        pool = ThreadPool(self.workers)
+
+        def work(outcome, func):
+            start = time.time()
+            try:
+                outcome.result = func()
+                outcome.ok = True
+                if not outcome.triples:
+                    #Whole files aren't counted up front; use VIVO's count.
+                    outcome.triples = outcome.statements
+            except Exception, e:
+                outcome.result = getattr(e, 'result', None)
+                outcome.error = str(e)
+                _logger.error("Upload of %s failed: %s" % (outcome.name, e))
+            outcome.seconds = time.time() - start
+            if adaptive is not None:
+                adaptive.observe(outcome.seconds, error=not outcome.ok)
+            with lock:
+                report.outcomes.append(outcome)
+            slots.release()
+
+        try:
+            for outcome, func in tasks:
+                slots.acquire()
+                pool.apply_async(work, (outcome, func))
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+        report.finish()
+        _logger.info(report.summary())
+        return report
+
+    def upload_files(self, paths, mode='add', format='N3'):
+        """
+        Upload whole files concurrently.  Returns an UploadReport.
+        """
+        if mode not in BULK_MODES:
+            raise Exception("Unknown upload mode %s.  Options are add, remove." % mode)
+        if mode == 'add':
+            method = self.session.add_rdf
+        else:
+            method = self.session.remove_rdf
+
+        def tasks():
+            for path in paths:
+                outcome = UploadOutcome(path, os.path.getsize(path))
+                yield outcome, lambda path=path: method(path, format=format)
+
+        return self._run(tasks())
+
+    def upload_batches(self, file_path, mode='add', batch_size=BATCH_SIZE,
+                       format='N-TRIPLE', adaptive=None):
+        """
+        Split an N-Triples file into batches and upload them
+        concurrently.  Returns an UploadReport.
+
+        adaptive is an optional web_client.AdaptiveBatchSize that
+        sizes each batch and caps the uploads in flight, at most
+        this pool's workers, from VIVO's response times.
+        """
+        if mode not in BULK_MODES:
+            raise Exception("Unknown upload mode %s.  Options are add, remove." % mode)
+        if format.upper() not in LINE_FORMATS:
+            raise Exception("Batch uploads require N-Triples input, not %s." % format)
+        filename, extension = get_name_extension(file_path)
+        if adaptive is not None:
+            adaptive.max_workers = self.workers
+            adaptive.workers = min(adaptive.workers, self.workers)
+
+        def tasks():
+            batches = iter_triple_batches(file_path, adaptive or batch_size)
+            for number, batch in enumerate(batches, 1):
+                name = '%s-%d.nt' % (filename, number)
+                data = ''.join(batch)
+                outcome = UploadOutcome(name, len(data), len(batch))
+                post = lambda name=name, data=data: self.session.post_batch(
+                    BULK_MODES[mode], name, data, format)
+                yield outcome, post
+
+        return self._run(tasks(), adaptive)
+
+
+def upload_files(session, paths, mode='add', format='N3', workers=WORKERS):
+    """
+    Shortcut for uploading many files with an UploadPool.
+    """
+    return UploadPool(session, workers=workers).upload_files(
+        paths, mode=mode, format=format)
@@ -6,27 +6,165 @@ At the moment, will only return RS_JSON for SELECT and
 N3 for CONSTRUCT queries.
 
 """
-import csv
-from StringIO import StringIO
-import urllib
-import urllib2
+import codecs
+import copy
+import gzip
+import json
+import re
+import sys
+from multiprocessing.pool import ThreadPool
 import warnings
 
 from rdflib import Graph
 
-from SPARQLWrapper import SPARQLWrapper, JSON, N3
+from SPARQLWrapper import SPARQLWrapper, JSON, N3, POST
 from SPARQLWrapper.SPARQLExceptions import QueryBadFormed, EndPointNotFound, EndPointInternalError
 from SPARQLWrapper.Wrapper import _SPARQL_JSON
 
 #VIVO returns its RS_JSON as application/javascript
 _SPARQL_JSON.append('application/javascript')
 
-from web_client import Session
+from web_client import Session, POOL_SIZE
+from models.vivo import prep_query
 
 #logging
 import logging
 _logger = logging.getLogger(__name__)
 
+#Rows fetched per request when paging through SELECT results.
+PAGE_SIZE = 1000
+
+#VIVO SPARQL end point, relative to the VIVO url.
+SPARQL_PATH = 'admin/sparqlquery'
+
+#Default number of queries run at once by query_many.
+WORKERS = 4
+
+#Bytes read from the response at a time when streaming results.
+CHUNK_SIZE = 64 * 1024
+
+#Start of the bindings array in RS_JSON results.
+BINDINGS_START = re.compile(r'"bindings"\s*:\s*\[')
+
+#Trailing LIMIT and OFFSET clauses of a query.
+TRAILING_SLICE = re.compile(r'\s+(LIMIT|OFFSET)\s+(\d+)\s*$', re.IGNORECASE)
+#Trailing ORDER BY clause, once LIMIT and OFFSET are removed.
+TRAILING_ORDER = re.compile(r'\s+ORDER\s+BY\s+[^}]*$', re.IGNORECASE)
+
+
+class ResponseStream(object):
+    """
+    File-like view of a streamed requests response, as returned
+    by urllib2, for SPARQLWrapper's result conversion.  Content
+    is decoded (gzip, deflate) as it is read.
+    """
+
+    def __init__(self, response, chunk_size=CHUNK_SIZE):
+        self.response = response
+        self.chunks = response.iter_content(chunk_size)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while (size is None) or (size < 0) or (len(self.buffer) < size):
+            try:
+                self.buffer += self.chunks.next()
+            except StopIteration:
+                break
+        if (size is None) or (size < 0):
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def info(self):
+        return self.response.headers
+
+    def geturl(self):
+        return self.response.url
+
+    def close(self):
+        self.response.close()
+
+
+def iter_json_bindings(response, chunk_size=CHUNK_SIZE):
+    """
+    Incrementally parse SPARQL JSON results from a file-like
+    response and yield each binding dict as soon as it has been
+    read.  Only the binding being parsed is buffered.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+    buf = u''
+    pos = None
+    try:
+        while True:
+            if pos is None:
+                match = BINDINGS_START.search(buf)
+                if match is not None:
+                    pos = match.end()
+            if pos is not None:
+                #Decode as many complete bindings as are buffered.
+                while True:
+                    while (pos < len(buf)) and (buf[pos] in u' \t\r\n,'):
+                        pos += 1
+                    if pos == len(buf):
+                        break
+                    if buf[pos] == u']':
+                        return
+                    try:
+                        binding, end = decoder.raw_decode(buf, pos)
+                    except ValueError:
+                        #Incomplete binding; read more.
+                        break
+                    yield binding
+                    pos = end
+                buf = buf[pos:]
+                pos = 0
+            chunk = response.read(chunk_size)
+            if not chunk:
+                raise ValueError("SPARQL JSON results ended before the bindings did.")
+            buf += utf8.decode(chunk)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+
+
+def split_slice(query):
+    """
+    Remove any trailing LIMIT and OFFSET from a query.
+    Returns (query, limit, offset); limit is None when absent.
+    """
+    limit, offset = None, 0
+    match = TRAILING_SLICE.search(query)
+    while match:
+        if match.group(1).upper() == 'LIMIT':
+            limit = int(match.group(2))
+        else:
+            offset = int(match.group(2))
+        query = query[:match.start()]
+        match = TRAILING_SLICE.search(query)
+    return (query.rstrip(), limit, offset)
+
+
+def offset_page(query, limit, offset):
+    """
+    Rewrite a query without LIMIT and OFFSET to fetch one page.
+    """
+    return "%s\nLIMIT %d\nOFFSET %d" % (query, limit, offset)
+
+
+def keyset_page(query, key, limit, after=None):
+    """
+    Rewrite a query without solution modifiers to fetch one page
+    ordered on ?key, starting at rows where ?key >= after.
+    """
+    query = TRAILING_ORDER.sub('', query).rstrip()
+    if not query.endswith('}'):
+        raise Exception("Keyset paging needs a query ending in its WHERE clause.")
+    if after is not None:
+        literal = after.replace('\\', '\\\\').replace('"', '\\"')
+        query = '%s  FILTER(STR(?%s) >= "%s")\n}' % (query[:-1], key, literal)
+    return "%s\nORDER BY STR(?%s)\nLIMIT %d" % (query, key, limit)
+
 
 class VIVOSparql(SPARQLWrapper):
     """
@@ -37,13 +175,21 @@ class VIVOSparql(SPARQLWrapper):
 
     def __init__(self, **kwargs):
         self.url = kwargs.get('url')
-        if self.url:
-            self.vweb = Session(url=self.url)
+        pool_size = kwargs.get('pool_size', POOL_SIZE)
+        if kwargs.get('vweb') is not None:
+            #Share an existing, possibly logged-in, web_client.Session.
+            self.vweb = kwargs['vweb']
+        elif self.url:
+            self.vweb = Session(url=self.url, pool_size=pool_size)
         else:
-            self.vweb = Session()
+            self.vweb = Session(pool_size=pool_size)
         self.session = None
+        if self.vweb.logged_in:
+            self.session = self.vweb.session
         #Add the VIVO SPARQL end point path to the VIVO url.
-        self.endpoint = self.vweb.url + 'admin/sparqlquery'
+        self.endpoint = self.vweb.url + SPARQL_PATH
+        #setQuery checks format and is called by SPARQLWrapper.__init__.
+        self.format = None
         SPARQLWrapper.__init__(self, self.endpoint, kwargs)
         #The resultFormat and rdfResultFormat are required
         #parameters for the VIVO SPARQL interface.
@@ -55,6 +201,11 @@ class VIVOSparql(SPARQLWrapper):
         self.format = None
         self.username = kwargs.get('username')
         self.password = kwargs.get('password')
+        #When True, SELECT results are parsed incrementally and
+        #queryAndConvert returns an iterator of bindings.
+        self.stream = kwargs.get('stream', False)
+        #Optional cache.QueryCache for SELECT and CONSTRUCT results.
+        self.cache = kwargs.get('cache')
 
     def login(self):
         """
@@ -67,7 +218,6 @@ class VIVOSparql(SPARQLWrapper):
             kw['password'] = self.password
         self.vweb.login(**kw)
         self.session = self.vweb.session
-        self.cookies = urllib.urlencode(self.session.cookies)
 
     def logout(self):
         """
@@ -92,58 +242,239 @@ class VIVOSparql(SPARQLWrapper):
 
     def _query(self):
         """
-        Override _query method to use cookies acquired on login.
+        Override _query method to send the query over the logged-in
+        web_client.Session, which keeps pooled keep-alive connections
+        and decodes gzipped responses.  Queries are retried by the
+        session's transport and time out after setTimeout seconds,
+        or the transport's query timeout.
         """
-        request = self._createRequest()
+        if self.vweb.logged_in != True:
+            raise Exception("VIVO session not created.  Need to call login.")
+        headers = {
+            'Accept': self._getAcceptHeader(),
+            'User-Agent': self.agent,
+        }
+        headers.update(self.customHttpHeaders)
+        data = self._getRequestEncodedParameters(("query", self.queryString))
+        if self.method == POST:
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            resp = self.vweb.request('post', SPARQL_PATH, operation='query',
+                                     idempotent=True, data=data,
+                                     headers=headers, stream=True,
+                                     timeout=self.timeout)
+        else:
+            resp = self.vweb.request('get', SPARQL_PATH + '?' + data,
+                                     operation='query', idempotent=True,
+                                     headers=headers, stream=True,
+                                     timeout=self.timeout)
+        if resp.status_code == 400:
+            raise QueryBadFormed(resp.content)
+        elif resp.status_code == 404:
+            raise EndPointNotFound(resp.content)
+        elif resp.status_code == 500:
+            raise EndPointInternalError(resp.content)
+        resp.raise_for_status()
+        return (ResponseStream(resp), self.returnFormat)
+
+    def queryAndConvert(self):
+        """
+        In stream mode, return an iterator over the bindings of a
+        SELECT, parsed from the response as it arrives.
+        """
+        if self.stream and (self.returnFormat == JSON):
+            response, rformat = self._query()
+            return iter_json_bindings(response)
+        if (self.cache is None) or (self.returnFormat not in (JSON, N3)):
+            return SPARQLWrapper.queryAndConvert(self)
+        cache_format = '%s %s' % (self.returnFormat, self.parameters.get('resultFormat'))
+        cached = self.cache.get(self.queryString, cache_format, self.endpoint)
+        if cached is not None:
+            if self.returnFormat == JSON:
+                return json.loads(cached)
+            return cached
+        results = SPARQLWrapper.queryAndConvert(self)
+        if self.returnFormat == JSON:
+            self.cache.put(self.queryString, cache_format, json.dumps(results),
+                           self.endpoint)
+        else:
+            self.cache.put(self.queryString, cache_format, results, self.endpoint)
+        return results
+
+    def clone(self):
+        """
+        Copy sharing the login but with its own query state, so
+        queries can run on several threads at once.
+        """
+        other = copy.copy(self)
+        other.parameters = copy.deepcopy(self.parameters)
+        other.customHttpHeaders = dict(self.customHttpHeaders)
+        return other
+
+    def query_many(self, queries, workers=WORKERS, ordered=True):
+        """
+        Run many queries concurrently, at most workers at a time,
+        and yield the converted results.  With ordered=True results
+        come in the order of queries; otherwise (index, result)
+        pairs are yielded as queries finish.
+        """
+        def run(item):
+            index, query = item
+            worker = self.clone()
+            worker.setQuery(query)
+            return (index, worker.queryAndConvert())
+
+        if self.vweb.pool_size < workers:
+            self.vweb.set_pool_size(workers)
+        pool = ThreadPool(workers)
         try:
-            opener = urllib2.build_opener()
-            opener.addheaders.append(('Cookie', self.cookies))
-            response = opener.open(request)
-            return (response, self.returnFormat)
-        except urllib2.HTTPError, e:
-            if e.code == 400:
-                raise QueryBadFormed()
-            elif e.code == 404:
-                raise EndPointNotFound()
-            elif e.code == 500:
-                raise EndPointInternalError(e.read())
+            if ordered:
+                for index, result in pool.imap(run, enumerate(queries)):
+                    yield result
             else:
-                raise e
-            return (None, self.returnFormat)
+                for pair in pool.imap_unordered(run, enumerate(queries)):
+                    yield pair
+        finally:
+            pool.terminate()
+
+    def query_template(self, template, bindings, workers=WORKERS,
+                       ordered=True, add_prefixes=False):
+        """
+        Fan a query template out over rows of bindings, each a
+        dictionary for models.vivo.prep_query, with query_many.
+        """
+        queries = (prep_query(template, row, add_prefixes=add_prefixes)
+                   for row in bindings)
+        return self.query_many(queries, workers=workers, ordered=ordered)
+
+    def iter_select(self, query, page_size=PAGE_SIZE, key=None):
+        """
+        Run a SELECT query page by page and yield one binding dict
+        at a time, so only page_size rows are held in memory and no
+        single request has to return the full result.
+
+        By default pages are fetched with LIMIT and OFFSET; the query
+        should have an ORDER BY for the pages to be stable.  Pass
+        key, a variable name such as 's', to page on that variable's
+        value instead, which stays fast deep into large results.  A
+        LIMIT in the query caps the total number of rows yielded.  An
+        OFFSET can only be used without key.
+        """
+        query, limit, offset = split_slice(query)
+        if offset and (key is not None):
+            raise Exception("OFFSET can't be combined with paging on ?%s." % key)
+        yielded = 0
+        after = None
+        while (limit is None) or (yielded < limit):
+            size = page_size
+            if limit is not None:
+                size = min(page_size, limit - yielded)
+            if key is None:
+                requested = size
+                page_query = offset_page(query, size, offset)
+            else:
+                requested = page_size
+                page_query = keyset_page(query, key, page_size, after)
+            self.setQuery(page_query)
+            rows = self.queryAndConvert()
+            if not self.stream:
+                rows = rows['results']['bindings']
+            rows = list(rows)
+            full = len(rows) >= requested
+            if key is not None:
+                if full:
+                    #Hold back rows sharing the last key.  They are
+                    #fetched whole with the next page.
+                    last = rows[-1][key]['value']
+                    rows = [r for r in rows if r[key]['value'] != last]
+                    if not rows:
+                        raise Exception("More than %d rows for ?%s = %s. "
+                                        "Use a larger page_size." % (page_size, key, last))
+                    after = last
+                rows = rows[:size]
+            for row in rows:
+                yield row
+            yielded += len(rows)
+            offset += len(rows)
+            if not full:
+                break
 
     def results_graph(self):
         """
         Shortcut for use with CONSTRUCT queries.  Returns
         results as an RDFLib graph.
         """
+        g = Graph()
+        if self.cache is not None:
+            g.parse(data=self.queryAndConvert(), format='n3')
+            return g
         resp, rformat = self._query()
         if rformat == 'N3':
             rformat = 'n3'
-        g = Graph()
         g.parse(resp, format=rformat)
         return g
 
-    def results_csv(self, query, filename='results.csv'):
+    def set_result_format(self, format):
+        """
+        Replace the VIVO resultFormat parameter used for SELECTs.
+        """
+        if hasattr(self, 'clearParameter'):
+            self.clearParameter('resultFormat')
+        self.addCustomParameter('resultFormat', format)
+
+    def results_csv(self, query, filename='results.csv', compress=None,
+                    progress=None, chunk_size=CHUNK_SIZE):
         """
-        Shortcut for use with SELECT queries.  Outpus
-        as CSV file.
+        Shortcut for use with SELECT queries.  Streams VIVO's CSV
+        output in chunk_size pieces, so the results are never held
+        in memory.
+
+        filename is a path, an open file-like object or '-' for
+        stdout.  The output is gzipped when compress is True, or
+        when compress is None and filename ends in .gz.  progress,
+        if given, is called with (lines, bytes) written so far
+        after each chunk.
         """
         #Hide warnings.  CSV isn't recognized by SPARQLWrapper.
         warnings.simplefilter("ignore")
-        format = 'vitro:csv'
-        self.addCustomParameter('resultFormat', format)
+        self.set_result_format('vitro:csv')
         self.format = 'csv'
-        self.setQuery(query)
-        results = self.queryAndConvert()
-        rows = csv.reader(StringIO(results.read()))
-        with open(filename, 'wb') as f:
-            writer = csv.writer(f)
-            writer.writerows(rows)
+        try:
+            self.setQuery(query)
+            response, rformat = self._query()
+        finally:
+            self.set_result_format('RS_JSON')
+            self.format = None
+        if hasattr(filename, 'write'):
+            out, close = filename, False
+        elif filename == '-':
+            out, close = sys.stdout, False
+        else:
+            out, close = open(filename, 'wb'), True
+            if compress is None:
+                compress = filename.endswith('.gz')
+        target = out
+        if compress:
+            target = gzip.GzipFile(fileobj=out, mode='wb')
+        lines = written = 0
+        try:
+            while True:
+                chunk = response.read(chunk_size)
+                if not chunk:
+                    break
+                target.write(chunk)
+                lines += chunk.count('\n')
+                written += len(chunk)
+                if progress is not None:
+                    progress(lines, written)
+        finally:
+            response.close()
+            if compress:
+                target.close()
+            if close:
+                out.close()
         return True
 
 
-
-
 if __name__ == "__main__":
     #Simple query to see if all is working as expected.
     q = """
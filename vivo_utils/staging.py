@@ -0,0 +1,126 @@
+"""
+Bulk load through a staging named graph.
+
+Every upload to VIVO's ABox makes the reasoner and the search
+indexer process the new statements as they arrive, which is the
+main cost of a large load.  Here files are first loaded into a
+separate named graph, copied into the ABox in one step with the
+ingest tool, and followed by a single recompute of inferences and
+rebuild of the search index.  The admin pages are polled until both
+finish so the time of the whole load can be measured.
+
+    with Session() as vs:
+        report = staged_load(paths, session=vs)
+        print report.summary()
+
+"""
+import time
+
+from web_client import UPLOAD_ERROR, add_rdf_to_named_graph, clear_named_graph, \
+    created_named_graph, get_session, notify_change, rebuild_index, \
+    recompute_inferences, POLL_INTERVAL, WAIT_TIMEOUT
+
+#logging
+import logging
+_logger = logging.getLogger(__name__)
+
+#Named graph files are staged in.
+STAGING_GRAPH = 'http://localhost/staged'
+#VIVO's asserted ABox graph.
+KB2 = 'http://vitro.mannlib.cornell.edu/default/vitro-kb-2'
+#Copies every statement of the source models.
+COPY_QUERY = 'CONSTRUCT { ?s ?p ?o } WHERE { ?s ?p ?o }'
+
+
+def copy_named_graph(source, destination=KB2, session=None):
+    """
+    Copy the statements in named graph source into destination
+    with the ingest tool's SPARQL CONSTRUCT action.
+    """
+    s = session or get_session()
+    params = {
+        'action': 'executeSparql',
+        'sourceModelName': source,
+        'destinationModelName': destination,
+        'sparqlQueryStr': COPY_QUERY,
+        'submit': 'Execute CONSTRUCT',
+    }
+    r = s.request('post', 'ingest', operation='upload', data=params)
+    if r.status_code != 200:
+        raise Exception('Copying %s to %s failed:\n%s' % (source, destination, r.content))
+    match = UPLOAD_ERROR.search(r.content)
+    if match is not None:
+        raise Exception('Copying %s to %s failed: %s' % (source, destination, match.group(1)))
+    notify_change()
+    if s.ledger is not None:
+        s.ledger.invalidate(s.url, 'add')
+    return True
+
+
+class StagedLoadReport(object):
+    """
+    Seconds spent in each phase of a staged load.
+    """
+
+    def __init__(self):
+        self.files = 0
+        self.statements = 0
+        self.phases = []
+        self.started = time.time()
+        self.elapsed = 0.0
+
+    def phase(self, name, seconds):
+        _logger.info("%s took %.1fs." % (name, seconds))
+        self.phases.append((name, seconds))
+
+    def finish(self):
+        self.elapsed = time.time() - self.started
+
+    def summary(self):
+        phases = ', '.join('%s %.1fs' % p for p in self.phases)
+        return "Loaded %d files (%d statements) in %.1fs: %s." % (
+            self.files, self.statements, self.elapsed, phases)
+
+
+def staged_load(paths, session=None, graph=STAGING_GRAPH, format='N3',
+                destination=KB2, recompute=True, reindex=True, wait=True,
+                interval=POLL_INTERVAL, timeout=WAIT_TIMEOUT):
+    """
+    Load files into graph, copy graph into destination, clear it,
+    then recompute inferences and rebuild the search index once.
+    With wait, return only after VIVO reports both jobs finished.
+
+    Returns a StagedLoadReport.
+    """
+    s = session or get_session()
+    report = StagedLoadReport()
+
+    start = time.time()
+    created_named_graph(graph, session=s)
+    clear_named_graph(graph, session=s)
+    for path in paths:
+        result = add_rdf_to_named_graph(path, graph, format=format, session=s)
+        report.files += 1
+        report.statements += getattr(result, 'statements', 0)
+    report.phase('stage', time.time() - start)
+
+    start = time.time()
+    copy_named_graph(graph, destination, session=s)
+    clear_named_graph(graph, session=s)
+    report.phase('copy', time.time() - start)
+
+    if recompute:
+        start = time.time()
+        recompute_inferences(None, session=s, wait=wait, interval=interval,
+                             timeout=timeout)
+        report.phase('recompute', time.time() - start)
+
+    if reindex:
+        start = time.time()
+        rebuild_index(None, session=s, wait=wait, interval=interval,
+                      timeout=timeout)
+        report.phase('reindex', time.time() - start)
+
+    report.finish()
+    _logger.info(report.summary())
+    return report
@@ -0,0 +1,216 @@
+"""
+Sync a local graph with VIVO by uploading only what changed.
+
+For each subject in a local graph (e.g. a models.vivo.VGraph built by
+a nightly job) the statements VIVO holds about it are fetched with a
+CONSTRUCT, compared with the local statements and only the
+differences are removed and added.  A hash of each subject's local
+statements is kept on disk after a successful sync; subjects whose
+hash has not changed since are skipped without querying VIVO.
+
+Only the statements asserted in VIVO's ABox graph, models.vivo.kb2,
+are compared.  Inferences and other named graphs are left alone and
+a local statement VIVO only infers is still asserted.  Predicates
+VIVO maintains itself are ignored, see IGNORE.  Blank nodes cannot
+be compared and are not supported.
+
+"""
+import hashlib
+import sqlite3
+import threading
+
+from rdflib import Graph, URIRef
+
+from models.vivo import VITRO, kb2
+from web_client import BULK_MODES
+
+#logging
+import logging
+_logger = logging.getLogger(__name__)
+
+#Subjects fetched from VIVO per CONSTRUCT.
+CHUNK_SIZE = 50
+
+#Predicates maintained by VIVO that are never synced.
+IGNORE = frozenset([
+    VITRO.mostSpecificType,
+])
+
+
+def subject_triples(graph, subject, ignore=IGNORE):
+    """
+    Set of statements about subject, less ignored predicates.
+    """
+    return set(
+        (subject, p, o) for p, o in graph.predicate_objects(subject)
+        if p not in ignore
+    )
+
+
+def triples_hash(triples):
+    """
+    Order independent hash of a set of statements.
+    """
+    lines = sorted(u'%s %s %s' % (s.n3(), p.n3(), o.n3()) for s, p, o in triples)
+    return hashlib.sha1(u'\n'.join(lines).encode('utf-8')).hexdigest()
+
+
+def to_ntriples(triples):
+    """
+    Serialize statements as N-Triples.
+    """
+    g = Graph()
+    for triple in triples:
+        g.add(triple)
+    return g.serialize(format='nt')
+
+
+def describe_query(subjects, graph=kb2):
+    """
+    CONSTRUCT the statements in graph about several subjects at
+    once.  With graph None, every graph VIVO serves, including
+    inferences, is read.
+    """
+    values = u' '.join(s.n3() for s in subjects)
+    pattern = u'?s ?p ?o .'
+    if graph is not None:
+        pattern = u'GRAPH %s { %s }' % (graph.n3(), pattern)
+    return u"""
+    CONSTRUCT { ?s ?p ?o }
+    WHERE {
+        VALUES ?s { %s }
+        %s
+    }
+    """ % (values, pattern)
+
+
+class SyncState(object):
+    """
+    Hash of each subject's statements as of its last sync,
+    kept in SQLite per VIVO url.
+    """
+
+    def __init__(self, path, url):
+        self.url = url
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            """create table if not exists subjects (
+                url text,
+                subject text,
+                hash text,
+                primary key (url, subject)
+            )"""
+        )
+        self.db.commit()
+
+    def get(self, subject):
+        with self.lock:
+            row = self.db.execute(
+                'select hash from subjects where url = ? and subject = ?',
+                (self.url, unicode(subject))
+            ).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_many(self, hashes):
+        with self.lock:
+            self.db.executemany(
+                'insert or replace into subjects values (?, ?, ?)',
+                [(self.url, unicode(s), h) for s, h in hashes.items()]
+            )
+            self.db.commit()
+
+    def forget(self):
+        """
+        Drop all hashes so the next sync compares every subject.
+        """
+        with self.lock:
+            self.db.execute('delete from subjects where url = ?', (self.url,))
+            self.db.commit()
+
+
+class SyncReport(object):
+
+    def __init__(self):
+        self.subjects = 0
+        self.unchanged = 0
+        self.compared = 0
+        self.added = 0
+        self.removed = 0
+
+    def summary(self):
+        return "%d subjects: %d unchanged, %d compared, %d statements added, %d removed." % (
+            self.subjects, self.unchanged, self.compared, self.added, self.removed)
+
+
+def diff_subjects(local, remote, subjects, ignore=IGNORE):
+    """
+    Statements to add and remove, for the given subjects, to turn
+    the remote graph into the local one.
+    """
+    add = set()
+    remove = set()
+    for subject in subjects:
+        mine = subject_triples(local, subject, ignore)
+        theirs = subject_triples(remote, subject, ignore)
+        add |= mine - theirs
+        remove |= theirs - mine
+    return add, remove
+
+
+def sync_graph(local, session, sparql, state=None, chunk_size=CHUNK_SIZE,
+               ignore=IGNORE):
+    """
+    Make VIVO's statements about each URI subject of local match
+    local, uploading only the differences.
+
+    session is a logged-in web_client.Session and sparql a
+    logged-in sparql.VIVOSparql.  state is an optional SyncState;
+    subjects unchanged since their last sync are skipped.
+
+    Returns a SyncReport.
+    """
+    report = SyncReport()
+    subjects = [s for s in set(local.subjects()) if isinstance(s, URIRef)]
+    report.subjects = len(subjects)
+    hashes = {}
+    todo = []
+    for subject in subjects:
+        digest = triples_hash(subject_triples(local, subject, ignore))
+        if (state is not None) and (state.get(subject) == digest):
+            report.unchanged += 1
+            continue
+        hashes[subject] = digest
+        todo.append(subject)
+
+    for start in range(0, len(todo), chunk_size):
+        chunk = todo[start:start + chunk_size]
+        sparql.setQuery(describe_query(chunk))
+        remote = sparql.results_graph()
+        add, remove = diff_subjects(local, remote, chunk, ignore)
+        name = 'sync-%d' % (start / chunk_size + 1)
+        #Adding or removing the same statements twice leaves VIVO as
+        #once, and a chunk is only marked synced in state when done,
+        #so uploads can be retried when state is kept.  The deltas
+        #come from VIVO's current statements, so an upload ledger
+        #must not skip them.
+        retry = state is not None
+        if remove:
+            session.post_batch(BULK_MODES['remove'], name + '-remove.nt',
+                               to_ntriples(remove), 'N-TRIPLE', idempotent=retry,
+                               use_ledger=False)
+        if add:
+            session.post_batch(BULK_MODES['add'], name + '-add.nt',
+                               to_ntriples(add), 'N-TRIPLE', idempotent=retry,
+                               use_ledger=False)
+        report.compared += len(chunk)
+        report.added += len(add)
+        report.removed += len(remove)
+        if state is not None:
+            state.set_many(dict((s, hashes[s]) for s in chunk))
+        _logger.debug("Synced %d subjects: %d added, %d removed." %
+                      (len(chunk), len(add), len(remove)))
+    _logger.info(report.summary())
+    return report
@@ -0,0 +1,28 @@
+"""
+Test the non-blocking client without a VIVO instance.
+"""
+import threading
+
+import nose
+
+from . import async_client
+
+def test_async_client_cancel():
+    client = async_client.AsyncClient()
+    release = threading.Event()
+    first = client.submit('admin', 'first', release.wait)
+    second = client.submit('admin', 'second', lambda: 'ran')
+    third = client.submit('query', 'third', lambda: 1 / 0)
+    assert second.cancel()
+    release.set()
+    assert first.result(5) == True
+    nose.tools.assert_raises(async_client.JobCancelled, second.result, 5)
+    nose.tools.assert_raises(ZeroDivisionError, third.result, 5)
+    done = []
+    third.add_done_callback(done.append)
+    assert done == [third]
+    client.close()
+
+
+if __name__ == '__main__':
+    nose.main()
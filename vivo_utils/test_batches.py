@@ -0,0 +1,200 @@
+"""
+Test the batching helpers used for bulk uploads.  These
+do not require a VIVO instance.
+"""
+import os
+from tempfile import NamedTemporaryFile, mkdtemp
+
+import nose
+
+os.environ.setdefault('VIVO_URL', 'http://vivo.school.edu/')
+
+from . import pipeline, web_client
+
+ntriples = """# comment
+<http://vivo.school.edu/individual/a> <http://www.w3.org/2000/01/rdf-schema#label> "A" .
+<http://vivo.school.edu/individual/b> <http://www.w3.org/2000/01/rdf-schema#label> "B" .
+
+<http://vivo.school.edu/individual/c> <http://www.w3.org/2000/01/rdf-schema#label>
+    "C" .
+"""
+
+def test_iter_triple_batches():
+    with NamedTemporaryFile() as f:
+        f.write(ntriples)
+        f.flush()
+        batches = list(web_client.iter_triple_batches(f.name, batch_size=2))
+    assert [len(b) for b in batches] == [2, 1]
+    #Statement split over two lines is kept whole.
+    assert batches[1][0].rstrip().endswith('"C" .')
+    assert all(line.endswith(' .\n') for b in batches for line in b)
+
+def test_iter_statements_comments():
+    with NamedTemporaryFile() as f:
+        f.write('<a> <b> "c" . # note\n'
+                '<a> <http://www.w3.org/2000/01/rdf-schema#label> "# not a comment ." .\n'
+                '<a> <b> "d" .#\n')
+        f.flush()
+        statements = list(web_client.iter_statements(f.name))
+    assert len(statements) == 3
+    assert statements[0] == '<a> <b> "c" . # note\n'
+    assert web_client.strip_comment(statements[1]).endswith('comment ." .')
+
+def test_checkpoint():
+    path = os.path.join(mkdtemp(), 'load.checkpoint')
+    assert web_client.read_checkpoint(path) == 0
+    assert web_client.read_checkpoint(None) == 0
+    web_client.write_checkpoint(path, 3)
+    assert web_client.read_checkpoint(path) == 3
+    os.remove(path)
+
+class FakeSession(object):
+    """
+    Stands in for a logged-in web_client.Session.
+    """
+    logged_in = True
+    pool_size = 1
+
+    def __init__(self):
+        self.posted = []
+
+    def set_pool_size(self, size):
+        self.pool_size = size
+
+    def post_batch(self, mode, name, data, format, idempotent=None, use_ledger=True):
+        if 'fail' in data:
+            raise Exception('Error posting batch %s.' % name)
+        self.posted.append((mode, name))
+        return True
+
+    def add_rdf(self, path, format='N3'):
+        self.posted.append(('directAddABox', path))
+        return web_client.UploadResult(path, 'directAddABox', 200, added=3)
+
+def test_upload_pool_batches():
+    session = FakeSession()
+    with NamedTemporaryFile() as f:
+        f.write(ntriples)
+        f.write('<http://x.edu/fail> <http://x.edu/p> "fail" .\n')
+        f.flush()
+        report = pipeline.UploadPool(session, workers=3).upload_batches(f.name, batch_size=1)
+    assert session.pool_size == 3
+    assert len(report.outcomes) == 4
+    assert len(report.succeeded) == 3
+    assert len(report.failed) == 1
+    assert set(m for m, n in session.posted) == set(['directAddABox'])
+
+def test_upload_pool_files():
+    session = FakeSession()
+    with NamedTemporaryFile(suffix='.n3') as f:
+        f.write(ntriples)
+        f.flush()
+        report = pipeline.UploadPool(session, workers=2).upload_files([f.name, f.name])
+    #Triples are the statements VIVO reported, for any format.
+    assert [o.triples for o in report.outcomes] == [3, 3]
+    assert report.triples_per_second > 0
+
+class FakeResponse(object):
+    url = 'http://vivo.school.edu/'
+
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+def test_parse_upload_response():
+    resp = FakeResponse('<p>Removed RDF from file post_sample.n3. Removed 12 statements.</p>')
+    result = web_client.parse_upload_response(resp, 'post_sample.n3', 'remove', 0.5)
+    assert result.ok
+    assert (result.removed, result.statements) == (12, 12)
+    resp = FakeResponse(
+        '<p>Could not load from file: edu.cornell.mannlib.vitro.webapp.rdfservice.'
+        'RDFServiceException: org.xml.sax.SAXParseException: The element type '
+        '"link" must be terminated.</p>')
+    result = web_client.parse_upload_response(resp, 'bad.rdf', 'directAddABox')
+    assert not result.ok
+    assert 'SAXParseException' in result.error
+    result = web_client.parse_upload_response(FakeResponse('', 500), 'x', 'remove')
+    assert result.error == 'HTTP 500'
+
+def test_upload_metrics():
+    session = web_client.Session(url='http://vivo.school.edu/')
+    pages = [
+        FakeResponse('Added RDF from file a-1.nt. Added 2 statements.'),
+        FakeResponse('Could not load from file: org.xml.sax.SAXParseException: bad'),
+    ]
+    session.request = lambda method, path, **kwargs: pages.pop(0)
+    result = session.post_batch('directAddABox', 'a-1.nt', ntriples, 'N-TRIPLE')
+    assert result.added == 2
+    try:
+        session.post_batch('directAddABox', 'a-2.nt', ntriples, 'N-TRIPLE')
+    except web_client.UploadError, e:
+        assert e.result.name == 'a-2.nt'
+    else:
+        assert False, "Load error not raised."
+    stats = session.metrics.stats()
+    assert (stats['uploads'], stats['failures'], stats['added']) == (2, 1, 2)
+    assert stats['failure_rate'] == 0.5
+
+def test_adaptive_batch_size():
+    control = web_client.AdaptiveBatchSize(100, minimum=10, maximum=200, target=10,
+                                           step=50, max_workers=3)
+    control.observe(1)
+    assert (control.size, control.workers) == (150, 2)
+    control.observe(20)
+    assert (control.size, control.workers) == (75, 1)
+    #Backs off once per target seconds.
+    control.observe(0, error=True)
+    assert control.size == 75
+
+def test_bulk_load_adaptive():
+    session = web_client.Session(url='http://vivo.school.edu/')
+    session.logged_in = True
+    sizes = []
+
+    def request(method, path, **kwargs):
+        name, data = kwargs['files']['rdfStream']
+        sizes.append(data.count('\n'))
+        if len(sizes) == 1:
+            return FakeResponse('', 500)
+        return FakeResponse('Added %d statements.' % sizes[-1])
+    session.request = request
+    session.transport.backoff = 0
+    control = web_client.AdaptiveBatchSize(2, minimum=1, target=10, step=1)
+    with NamedTemporaryFile() as f:
+        f.write(ntriples)
+        f.flush()
+        checkpoint = f.name + '.checkpoint'
+        posted = session.bulk_load(f.name, checkpoint=checkpoint, adaptive=control)
+    #Failed batch of two is retried as batches of one.
+    assert sizes == [2, 1, 2]
+    assert posted == 2
+    assert session.metrics.added == 3
+    assert not os.path.exists(checkpoint)
+
+def test_bulk_load_retries_shrink():
+    session = web_client.Session(url='http://vivo.school.edu/')
+    session.logged_in = True
+    session.transport.backoff = 0
+    sizes = []
+
+    def request(method, path, **kwargs):
+        name, data = kwargs['files']['rdfStream']
+        sizes.append(data.count('\n'))
+        if len(sizes) <= 3:
+            return FakeResponse('', 500)
+        return FakeResponse('Added %d statements.' % sizes[-1])
+    session.request = request
+    control = web_client.AdaptiveBatchSize(16, minimum=1, target=10, step=1)
+    with NamedTemporaryFile() as f:
+        for n in range(16):
+            f.write('<http://x.edu/%d> <http://x.edu/p> "%d" .\n' % (n, n))
+        f.flush()
+        session.bulk_load(f.name, adaptive=control)
+    #Quick repeated errors back the AdaptiveBatchSize off only once,
+    #but every retry is still cut.
+    assert sizes[:4] == [16, 8, 4, 2]
+    assert sum(sizes[3:]) == 16
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,73 @@
+"""
+Test the upload ledger without a VIVO instance.
+"""
+import os
+from tempfile import NamedTemporaryFile, mkdtemp
+
+import nose
+
+os.environ.setdefault('VIVO_URL', 'http://vivo.school.edu/')
+
+from . import ledger, web_client
+from .test_batches import FakeResponse, ntriples
+
+def test_ledger():
+    records = ledger.UploadLedger(os.path.join(mkdtemp(), 'ledger.db'))
+    session = web_client.Session(url='http://vivo.school.edu/', ledger=records)
+    posted = []
+
+    def request(method, path, **kwargs):
+        posted.append(kwargs['data']['mode'])
+        return type('Response', (object,), {'status_code': 200, 'content': ''})()
+    session.request = request
+    batch = ntriples.split('\n')[1:3]
+    session.post_batch('directAddABox', 'one', '\n'.join(batch), 'N-TRIPLE')
+    #Same statements in another order are not posted again.
+    session.post_batch('directAddABox', 'two', '\n'.join(reversed(batch)), 'N-TRIPLE')
+    session.post_batch('remove', 'three', '\n'.join(batch), 'N-TRIPLE')
+    session.post_batch('directAddABox', 'four', '\n'.join(batch), 'N-TRIPLE')
+    assert posted == ['directAddABox', 'remove', 'directAddABox']
+    #Removing other statements may undo part of an add, so it is
+    #posted again afterwards.
+    session.post_batch('remove', 'five', batch[0], 'N-TRIPLE')
+    session.post_batch('directAddABox', 'six', '\n'.join(batch), 'N-TRIPLE')
+    #Deltas bypass the ledger.
+    session.post_batch('directAddABox', 'seven', '\n'.join(batch), 'N-TRIPLE',
+                       use_ledger=False)
+    assert posted[3:] == ['remove', 'directAddABox', 'directAddABox']
+
+def test_ledger_file_hash():
+    records = ledger.UploadLedger(os.path.join(mkdtemp(), 'ledger.db'))
+    n3 = '@prefix ex: <http://x.edu/> .\r\nex:a ex:b "c" .\r\n' * 3
+    with NamedTemporaryFile() as f:
+        f.write(ntriples)
+        f.flush()
+        lines = ntriples.splitlines()
+        assert records.file_hash(f.name, 'N-TRIPLE') == \
+            records.data_hash('\n'.join(reversed(lines)), 'N-TRIPLE')
+    with NamedTemporaryFile() as f:
+        f.write(n3)
+        f.flush()
+        assert records.file_hash(f.name, 'N3') == records.data_hash(n3, 'N3')
+    #CRLF split across chunks.
+    assert ledger.chunks_hash(['a\r', '\nb'], 'N3') == records.data_hash('a\nb', 'N3')
+
+def test_ledger_module_add():
+    records = ledger.UploadLedger(os.path.join(mkdtemp(), 'ledger.db'))
+    session = web_client.Session(url='http://vivo.school.edu/', ledger=records)
+    posted = []
+
+    def request(method, path, **kwargs):
+        posted.append(kwargs['data']['action'])
+        return FakeResponse('Added 2 statements.')
+    session.request = request
+    with NamedTemporaryFile() as f:
+        f.write(ntriples)
+        f.flush()
+        web_client.add_rdf(f.name, format='N-TRIPLE', session=session)
+        web_client.add_rdf(f.name, format='N-TRIPLE', session=session)
+    assert posted == ['loadRDFData']
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,143 @@
+"""
+Test listview evaluation against a local rdflib graph.  These
+do not require a VIVO instance.
+"""
+import json
+import os
+import xml.etree.ElementTree as ET
+from StringIO import StringIO
+
+import nose
+
+from rdflib import Graph, Literal, Namespace, RDFS
+
+os.environ.setdefault('VIVO_URL', 'http://vivo.school.edu/')
+
+from . import generate_listview
+
+EX = Namespace('http://vivo.school.edu/individual/')
+
+graph = Graph()
+for n in range(6):
+    person = EX['person%d' % n]
+    for m in range(2):
+        pub = EX['pub%d-%d' % (n, m)]
+        graph.add((person, EX.authorOf, pub))
+        graph.add((pub, RDFS.label, Literal('Pub %d-%d' % (n, m))))
+
+constructs = [
+    """
+    CONSTRUCT { ?subject ?property ?pub . }
+    WHERE { ?subject ?property ?pub . }
+    """,
+    """
+    PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+    CONSTRUCT { ?pub rdfs:label ?label . }
+    WHERE { ?subject ?property ?pub . ?pub rdfs:label ?label . }
+    """,
+]
+
+
+class LocalSparql(object):
+    """
+    Answers construct queries from the local graph the way
+    VIVOSparql.query_many does.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def query_many(self, queries, workers=None, ordered=True):
+        for index, query in enumerate(queries):
+            self.queries.append(query)
+            yield index, graph.query(query).graph.serialize(format='n3')
+
+
+def subject_queries(subject):
+    return [
+        q.replace('?subject', '<%s>' % subject).replace('?property', '<%s>' % EX.authorOf)
+        for q in constructs
+    ]
+
+
+def test_run_constructs_inline():
+    #Parsed in this process by default.
+    g = generate_listview.run_constructs(LocalSparql(), subject_queries(EX.person1))
+    assert len(g) == 4
+    assert (EX['pub1-0'], RDFS.label, Literal('Pub 1-0')) in g
+
+
+def test_run_constructs_pool():
+    queries = subject_queries(EX.person2)
+    inline = generate_listview.run_constructs(LocalSparql(), queries)
+    pool = generate_listview.parser_pool(2)
+    try:
+        pooled = generate_listview.run_constructs(LocalSparql(), queries, pool=pool)
+    finally:
+        pool.terminate()
+    assert set(pooled) == set(inline)
+    assert generate_listview.parser_pool(1) is None
+
+
+def test_property_term():
+    assert generate_listview.property_term(EX.authorOf) == '<%s>' % EX.authorOf
+    assert generate_listview.property_term('core:authorInAuthorship') == 'core:authorInAuthorship'
+
+
+def test_values_construct():
+    q = generate_listview.values_construct(constructs[1], [EX.person1, EX.person2], 'ex:authorOf')
+    assert 'VALUES ?subject { <%s> <%s> }' % (EX.person1, EX.person2) in q
+    assert q.index('VALUES') > q.index('WHERE {')
+    assert '?property' not in q
+    assert '?subject ex:authorOf ?pub' in q
+    nose.tools.assert_raises(Exception, generate_listview.values_construct,
+                             'CONSTRUCT { ?s ?p ?o }', [EX.person1], 'ex:p')
+
+
+listview = """
+<list-view-config>
+    <query-select>
+    PREFIX rdfs: &lt;http://www.w3.org/2000/01/rdf-schema#&gt;
+    SELECT DISTINCT ?pub ?label WHERE {
+        ?subject &lt;%s&gt; ?pub .
+        ?pub rdfs:label ?label .
+    } ORDER BY ?label
+    </query-select>
+    <query-construct>%s</query-construct>
+    <query-construct>%s</query-construct>
+</list-view-config>
+"""
+
+def test_evaluate_batch():
+    root = ET.fromstring(listview % (
+        EX.authorOf,
+        constructs[0].replace('<', '&lt;'),
+        constructs[1].replace('<', '&lt;')
+    ))
+    sparql = LocalSparql()
+    subjects = [EX['person%d' % n] for n in range(5)]
+    out = StringIO()
+    pools = []
+    parser_pool = generate_listview.parser_pool
+    generate_listview.parser_pool = lambda processes: pools.append(processes) or \
+        parser_pool(processes)
+    try:
+        generate_listview.evaluate_batch(sparql, root, subjects, '<%s>' % EX.authorOf,
+                                         out=out, chunk_size=2, processes=2)
+    finally:
+        generate_listview.parser_pool = parser_pool
+    #One pool for the whole batch.
+    assert pools == [2]
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    chunks = [l for l in lines if 'chunk_construct_seconds' in l]
+    rows = [l for l in lines if 'subject' in l]
+    assert [c['subjects'] for c in chunks] == [2, 2, 1]
+    #Constructs run once per chunk, not per subject.
+    assert len(sparql.queries) == 6
+    assert [r['subject'] for r in rows] == [unicode(s) for s in subjects]
+    assert rows[4]['chunk'] == 3
+    assert [r['label'] for r in rows[3]['results']] == ['Pub 3-0', 'Pub 3-1']
+
+
+if __name__ == '__main__':
+    nose.main()
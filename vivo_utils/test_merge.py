@@ -0,0 +1,83 @@
+"""
+Test the batch merge helpers without a VIVO instance.
+"""
+import os
+import threading
+import time
+from tempfile import NamedTemporaryFile, mkdtemp
+
+import nose
+
+from . import merge
+
+
+class FakeSession(object):
+    """
+    Records merges and fails when two run into one primary at once.
+    """
+    logged_in = True
+    pool_size = 1
+
+    def __init__(self, fail=()):
+        self.merged = []
+        self.fail = set(fail)
+        self.busy = set()
+        self.lock = threading.Lock()
+
+    def set_pool_size(self, size):
+        self.pool_size = size
+
+    def merge(self, uri1, uri2):
+        with self.lock:
+            assert uri1 not in self.busy, "Concurrent merges into %s." % uri1
+            self.busy.add(uri1)
+        time.sleep(0.01)
+        with self.lock:
+            self.busy.remove(uri1)
+            if uri2 in self.fail:
+                raise Exception('Merge of %s failed.' % uri2)
+            self.merged.append((uri1, uri2))
+
+def test_collapse_pairs():
+    pairs = [
+        ('b', 'c'),
+        ('a', 'b'),
+        ('a', 'b'),
+        ('d', 'd'),
+        ('c', 'a'),
+        ('e', 'f'),
+    ]
+    merges = merge.collapse_pairs(pairs)
+    assert sorted(merges) == [('a', 'b'), ('a', 'c'), ('e', 'f')]
+    #A secondary stays with the first primary it was paired with.
+    assert merge.collapse_pairs([('a', 'b'), ('c', 'b')]) == [('a', 'b'), ('a', 'c')]
+
+def test_read_pairs():
+    with NamedTemporaryFile() as f:
+        f.write('uri1,uri2\nhttp://x.edu/a, http://x.edu/b\n\nhttp://x.edu/c,http://x.edu/d\n')
+        f.flush()
+        pairs = list(merge.read_pairs(f.name))
+    assert pairs == [('http://x.edu/a', 'http://x.edu/b'), ('http://x.edu/c', 'http://x.edu/d')]
+
+def test_merge_pairs():
+    pairs = [('a', 'b'), ('a', 'c'), ('a', 'd'), ('e', 'f'), ('e', 'g')]
+    session = FakeSession(fail=['g'])
+    checkpoint = os.path.join(mkdtemp(), 'merge.checkpoint')
+    seen = []
+    report = merge.merge_pairs(session, pairs, workers=4, checkpoint=checkpoint,
+                               progress=lambda done, total: seen.append(done))
+    assert (report.merged, len(report.failed), report.total) == (4, 1, 5)
+    assert session.pool_size == 4
+    assert sorted(seen) == range(1, 6)
+    #Merges into one primary run in order.
+    assert [s for p, s in session.merged if p == 'a'] == ['b', 'c', 'd']
+    #Completed merges are skipped when run again.
+    session = FakeSession()
+    report = merge.merge_pairs(session, pairs, checkpoint=checkpoint)
+    assert (report.merged, report.skipped) == (1, 4)
+    assert session.merged == [('e', 'g')]
+    assert merge.read_merged(checkpoint) == set(pairs)
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,265 @@
+"""
+Test VIVOSparql helpers against a local rdflib graph.  These
+do not require a VIVO instance.
+"""
+import gc
+import gzip
+import json
+import os
+import weakref
+from StringIO import StringIO
+from tempfile import mkdtemp
+
+import nose
+import requests
+from urllib3.response import HTTPResponse
+
+from rdflib import Graph, URIRef, Literal, RDFS
+
+os.environ.setdefault('VIVO_URL', 'http://vivo.school.edu/')
+
+from . import cache, mirror, sparql, web_client
+
+graph = Graph()
+for n in range(25):
+    s = URIRef('http://vivo.school.edu/individual/n%02d' % n)
+    graph.add((s, RDFS.label, Literal('Label %d' % n)))
+    if n % 5 == 0:
+        graph.add((s, RDFS.label, Literal('Alternate %d' % n)))
+
+
+class FakeResponse(StringIO):
+    """
+    File-like HTTP response with headers.
+    """
+
+    def __init__(self, body, content_type):
+        StringIO.__init__(self, body)
+        self.headers = {'content-type': content_type}
+
+    def info(self):
+        return self.headers
+
+
+class LocalSparql(sparql.VIVOSparql):
+    """
+    Answers queries from the local graph instead of VIVO.
+    """
+    requests = 0
+
+    def _query(self):
+        self.requests += 1
+        results = graph.query(self.queryString)
+        bindings = []
+        for row in results:
+            bindings.append(dict(
+                (str(var), {'type': 'literal', 'value': unicode(row[var])})
+                for var in results.vars
+            ))
+        body = json.dumps({'results': {'bindings': bindings}})
+        return (FakeResponse(body, 'application/javascript'), self.returnFormat)
+
+
+query = """
+PREFIX rdfs: <http://www.w3.org/2000/01/rdf-schema#>
+SELECT ?s ?label
+WHERE { ?s rdfs:label ?label . }
+"""
+
+def test_split_slice():
+    q, limit, offset = sparql.split_slice(query + "LIMIT 10 OFFSET 5\n")
+    assert (limit, offset) == (10, 5)
+    assert q == query.rstrip()
+
+def test_iter_select_offset():
+    s = LocalSparql()
+    rows = list(s.iter_select(query + "ORDER BY ?s ?label", page_size=7))
+    assert len(rows) == 30
+    assert s.requests == 5
+
+def test_iter_select_limit():
+    s = LocalSparql()
+    rows = list(s.iter_select(query + "ORDER BY ?s ?label LIMIT 10", page_size=7))
+    assert len(rows) == 10
+    assert s.requests == 2
+
+def test_iter_select_keyset():
+    s = LocalSparql()
+    rows = list(s.iter_select(query, page_size=4, key='s'))
+    assert len(rows) == 30
+    assert len(set((r['s']['value'], r['label']['value']) for r in rows)) == 30
+    nose.tools.assert_raises(Exception, list,
+                             s.iter_select(query + "OFFSET 5", page_size=4, key='s'))
+
+def test_iter_json_bindings():
+    results = {
+        'head': {'vars': ['bindings', 'label']},
+        'results': {'bindings': [
+            {'label': {'type': 'literal', 'value': u'Caf\xe9 [%d], {x}' % n}}
+            for n in range(10)
+        ]},
+    }
+    raw = StringIO(json.dumps(results, ensure_ascii=False).encode('utf-8'))
+    rows = list(sparql.iter_json_bindings(raw, chunk_size=7))
+    assert rows == results['results']['bindings']
+
+def test_iter_json_bindings_truncated():
+    raw = StringIO('{"results": {"bindings": [{"s": {"value": "a"}}, {"s": ')
+    rows = sparql.iter_json_bindings(raw, chunk_size=5)
+    assert rows.next() == {'s': {'value': 'a'}}
+    nose.tools.assert_raises(ValueError, rows.next)
+
+class CSVSparql(sparql.VIVOSparql):
+    """
+    Returns a fixed CSV response instead of querying VIVO.
+    """
+
+    def _query(self):
+        assert self.parameters['resultFormat'] == ['vitro:csv']
+        rows = ''.join('n%d,"Label %d"\r\n' % (n, n) for n in range(100))
+        return (FakeResponse('s,label\r\n' + rows, 'text/csv'), self.returnFormat)
+
+def test_results_csv_gzip():
+    s = CSVSparql()
+    path = os.path.join(mkdtemp(), 'results.csv.gz')
+    seen = []
+    s.results_csv(query, filename=path, chunk_size=64,
+                  progress=lambda lines, size: seen.append(lines))
+    with gzip.open(path) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 101
+    assert lines[1] == 'n0,"Label 0"'
+    assert seen[-1] == 101
+    assert s.parameters['resultFormat'] == ['RS_JSON']
+    os.remove(path)
+
+def test_results_csv_file_object():
+    s = CSVSparql()
+    out = StringIO()
+    s.results_csv(query, filename=out)
+    assert out.getvalue().startswith('s,label\r\nn0,')
+
+def test_query_cache():
+    c = cache.QueryCache(os.path.join(mkdtemp(), 'cache.db'), max_size=60)
+    c.put(query, 'json', 'a' * 30)
+    c.put(query + ' LIMIT 1', 'json', 'b' * 30)
+    #Whitespace differences share an entry.
+    assert c.get(' '.join(query.split()), 'json') == 'a' * 30
+    c.put(query + ' LIMIT 2', 'json', 'c' * 30)
+    #The least recently used entry was evicted.
+    assert c.get(query + ' LIMIT 1', 'json') is None
+    assert c.get(query, 'json') is not None
+    stats = c.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (2, 1, 2)
+    c.ttl = -1
+    assert c.get(query, 'json') is None
+    c.close()
+
+def test_query_cache_key():
+    c = cache.QueryCache(os.path.join(mkdtemp(), 'cache.db'))
+    c.put(query, 'json', 'a', endpoint='http://vivo.school.edu/api/sparqlQuery')
+    #Another VIVO instance doesn't share the entry.
+    assert c.get(query, 'json', endpoint='http://other.school.edu/api/sparqlQuery') is None
+    assert c.get(query, 'json', endpoint='http://vivo.school.edu/api/sparqlQuery') == 'a'
+    #Whitespace inside string literals is significant.
+    assert cache.normalize_query('SELECT  ?s\n WHERE { ?s ?p "a  b" }') == \
+        'SELECT ?s WHERE { ?s ?p "a  b" }'
+    assert cache.normalize_query("?s ?p '''x\n  \"y\" '''  .") == "?s ?p '''x\n  \"y\" ''' ."
+    assert cache.normalize_query(r'?s ?p "a\"  b" ;  ?q "c"') == r'?s ?p "a\"  b" ; ?q "c"'
+    assert c.key('?s ?p "a b"', 'json') != c.key('?s ?p "a  b"', 'json')
+    c.close()
+
+
+def test_cached_select():
+    c = cache.QueryCache(os.path.join(mkdtemp(), 'cache.db'))
+    s = LocalSparql(cache=c)
+    s.setQuery(query)
+    first = s.queryAndConvert()
+    s.setQuery(query)
+    assert s.queryAndConvert() == first
+    assert s.requests == 1
+    #Changes made through a Session clear the cache.
+    web_client.notify_change()
+    s.setQuery(query)
+    s.queryAndConvert()
+    assert s.requests == 2
+    #Closed and dropped caches are no longer cleared.
+    c.close()
+    web_client.notify_change()
+    with cache.QueryCache(os.path.join(mkdtemp(), 'cache.db')) as c:
+        assert c in cache._open_caches
+    assert c not in cache._open_caches
+    c = cache.QueryCache(os.path.join(mkdtemp(), 'cache.db'))
+    ref = weakref.ref(c)
+    del c
+    gc.collect()
+    assert ref() is None
+
+def test_query_template():
+    s = LocalSparql()
+    template = """
+    SELECT ?label
+    WHERE { ?s <http://www.w3.org/2000/01/rdf-schema#label> ?label . }
+    """
+    rows = [{'s': '<http://vivo.school.edu/individual/n%02d>' % n} for n in range(1, 10)]
+    results = list(s.query_template(template, rows, workers=3))
+    labels = [max(b['label']['value'] for b in r['results']['bindings'])
+              for r in results]
+    assert labels == ['Label %d' % n for n in range(1, 10)]
+    unordered = list(s.query_template(template, rows, workers=3, ordered=False))
+    assert sorted(i for i, r in unordered) == range(9)
+
+def test_response_stream_gzip():
+    body = StringIO()
+    with gzip.GzipFile(fileobj=body, mode='wb') as f:
+        f.write('x' * 1000)
+    resp = requests.Response()
+    resp.raw = HTTPResponse(
+        body=StringIO(body.getvalue()),
+        headers={'content-encoding': 'gzip'},
+        preload_content=False
+    )
+    stream = sparql.ResponseStream(resp, chunk_size=64)
+    assert stream.read(10) == 'x' * 10
+    assert stream.read() == 'x' * 990
+    assert stream.read(10) == ''
+
+class ConstructSparql(object):
+    """
+    Answers CONSTRUCT queries from the local graph.
+    """
+    queries = 0
+
+    def setQuery(self, query):
+        self.query = query
+
+    def results_graph(self):
+        self.queries += 1
+        return graph.query(self.query).graph
+
+def test_mirror():
+    path = os.path.join(mkdtemp(), 'mirror.db')
+    sparql = ConstructSparql()
+    m = mirror.Mirror(path, sparql)
+    subjects = ['http://vivo.school.edu/individual/n%02d' % n for n in range(5)]
+    assert m.refresh_subjects(subjects, max_age=60) == 5
+    assert m.refresh_subjects(subjects, max_age=60) == 0
+    assert sparql.queries == 1
+    m.close()
+    #Reopened, the mirror is queried without fetching anything.
+    m = mirror.Mirror(path, sparql)
+    g = m.graph()
+    assert len(g) == 6
+    q = """
+    select ?label
+    where { ?s rdfs:label ?label . }
+    """
+    rows = g.select(q, bind={'s': '<http://vivo.school.edu/individual/n00>'})
+    assert sorted(unicode(r.label) for r in rows) == [u'Alternate 0', u'Label 0']
+    m.store.replace_source(u'subject:' + subjects[0], [])
+    assert len(g) == 4
+    m.close()
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,56 @@
+"""
+Test staged bulk loads without a VIVO instance.
+"""
+import os
+from tempfile import NamedTemporaryFile
+
+import nose
+
+os.environ.setdefault('VIVO_URL', 'http://vivo.school.edu/')
+
+from . import staging, web_client
+from .test_batches import FakeResponse, ntriples
+
+def test_staged_load():
+    session = web_client.Session(url='http://vivo.school.edu/')
+    session.logged_in = True
+    sent = []
+    polls = {'RecomputeInferences': 2, 'SearchIndex': 2}
+
+    def request(method, path, **kwargs):
+        action = (kwargs.get('data') or {}).get('action')
+        sent.append((method, path, action))
+        if method == 'get':
+            #Busy for the first polls, then finished.
+            polls[path] -= 1
+            if path == 'RecomputeInferences':
+                busy = 'currently in the process of recomputing inferences.'
+                return FakeResponse(busy if polls[path] >= 0 else 'Recompute Inferences')
+            return FakeResponse('Rebuilding' if polls[path] >= 0 else 'The indexer is idle.')
+        if path == 'RecomputeInferences':
+            return FakeResponse('Recompute of inferences started. See vivo log for further details.')
+        if path == 'SearchIndex':
+            return FakeResponse('Preparing to rebuild the search index.')
+        return FakeResponse('Added RDF from file x. Added 3 statements.')
+    session.request = request
+    with NamedTemporaryFile() as f:
+        f.write(ntriples)
+        f.flush()
+        report = staging.staged_load([f.name], session=session, interval=0)
+    posts = [(p, a) for m, p, a in sent if m == 'post']
+    assert posts == [
+        ('ingest', 'createModel'),
+        ('ingest', 'clearModel'),
+        ('uploadRDF', None),
+        ('ingest', 'executeSparql'),
+        ('ingest', 'clearModel'),
+        ('RecomputeInferences', None),
+        ('SearchIndex', None),
+    ]
+    assert [p for m, p, a in sent if m == 'get'] == ['RecomputeInferences'] * 3 + ['SearchIndex'] * 3
+    assert [name for name, seconds in report.phases] == ['stage', 'copy', 'recompute', 'reindex']
+    assert report.statements == 3
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,63 @@
+"""
+Test graph sync against a local rdflib graph.  These do not
+require a VIVO instance.
+"""
+import os
+from tempfile import mkdtemp
+
+import nose
+
+from rdflib import ConjunctiveGraph, Graph, Literal, URIRef, RDF, RDFS
+
+os.environ.setdefault('VIVO_URL', 'http://vivo.school.edu/')
+
+from . import sync
+from .models.vivo import kb2
+from .test_batches import FakeSession
+
+class FakeSparql(object):
+    """
+    Answers CONSTRUCT queries from a local graph.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.queries = 0
+
+    def setQuery(self, query):
+        self.query = query
+
+    def results_graph(self):
+        self.queries += 1
+        return self.graph.query(self.query).graph
+
+def test_sync_graph():
+    a = URIRef('http://vivo.school.edu/individual/a')
+    b = URIRef('http://vivo.school.edu/individual/b')
+    person = URIRef('http://xmlns.com/foaf/0.1/Person')
+    agent = URIRef('http://xmlns.com/foaf/0.1/Agent')
+    remote = ConjunctiveGraph()
+    asserted = remote.get_context(kb2)
+    asserted.add((a, RDFS.label, Literal('Old')))
+    asserted.add((b, RDFS.label, Literal('B')))
+    inferred = remote.get_context(URIRef('http://vitro.mannlib.cornell.edu/default/vitro-kb-inf'))
+    inferred.add((a, RDF.type, agent))
+    inferred.add((b, RDF.type, person))
+    local = Graph()
+    local.add((a, RDFS.label, Literal('New')))
+    local.add((b, RDFS.label, Literal('B')))
+    local.add((b, RDF.type, person))
+    session = FakeSession()
+    sparql = FakeSparql(remote)
+    state = sync.SyncState(os.path.join(mkdtemp(), 'sync.db'), 'http://vivo.school.edu/')
+    report = sync.sync_graph(local, session, sparql, state=state)
+    #Inferences are not removed; a statement VIVO only infers is added.
+    assert (report.compared, report.added, report.removed) == (2, 2, 1)
+    assert [m for m, n in session.posted] == ['remove', 'directAddABox']
+    #Nothing changed locally, so VIVO is not queried again.
+    report = sync.sync_graph(local, session, sparql, state=state)
+    assert (report.unchanged, report.compared, sparql.queries) == (2, 0, 1)
+
+
+if __name__ == '__main__':
+    nose.main()
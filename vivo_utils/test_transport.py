@@ -0,0 +1,91 @@
+"""
+Test retries and the circuit breaker without a VIVO instance.
+"""
+import nose
+import requests
+
+from . import transport
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+    def close(self):
+        pass
+
+
+class FakeSession(object):
+    """
+    Returns, or raises, the given outcomes in order.
+    """
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.sent = []
+
+    def request(self, method, url, **kwargs):
+        self.sent.append(kwargs)
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+def test_retry_idempotent():
+    session = FakeSession(requests.exceptions.ReadTimeout(), 502, 200)
+    t = transport.Transport(session, backoff=0)
+    resp = t.send('post', 'http://vivo.school.edu/admin/sparqlquery',
+                  operation='query', idempotent=True)
+    assert resp.status_code == 200
+    assert len(session.sent) == 3
+    assert session.sent[0]['timeout'] == (10, transport.TIMEOUTS['query'])
+
+
+def test_no_retry_unsafe():
+    session = FakeSession(502, 200)
+    t = transport.Transport(session, backoff=0)
+    assert t.send('post', 'http://vivo.school.edu/uploadRDF').status_code == 502
+    session = FakeSession(requests.exceptions.ReadTimeout(), 200)
+    t = transport.Transport(session, backoff=0)
+    nose.tools.assert_raises(requests.exceptions.ReadTimeout, t.send,
+                             'post', 'http://vivo.school.edu/uploadRDF')
+    #Never reached VIVO, so safe to send again.
+    session = FakeSession(503, 200)
+    t = transport.Transport(session, backoff=0)
+    assert t.send('post', 'http://vivo.school.edu/uploadRDF').status_code == 200
+
+
+def test_circuit_breaker():
+    breaker = transport.CircuitBreaker(threshold=2, reset_after=60, max_wait=0.1)
+    session = FakeSession(503, 503, 200)
+    t = transport.Transport(session, retries=5, backoff=0, breaker=breaker)
+    nose.tools.assert_raises(transport.CircuitOpen, t.send, 'get', 'http://vivo.school.edu/')
+    assert breaker.open
+    assert len(session.sent) == 2
+    #Probe is let through once the circuit has been open long enough.
+    breaker.opened -= 60
+    assert t.send('get', 'http://vivo.school.edu/').status_code == 200
+    assert not breaker.open
+
+
+def test_circuit_breaker_probe_error():
+    breaker = transport.CircuitBreaker(threshold=1, reset_after=0, max_wait=1)
+    session = FakeSession(503, requests.exceptions.ChunkedEncodingError(),
+                          KeyboardInterrupt(), 200)
+    t = transport.Transport(session, retries=0, backoff=0, breaker=breaker)
+    assert t.send('get', 'http://vivo.school.edu/').status_code == 503
+    assert breaker.open
+    #Failed probes free the breaker for the next caller.
+    nose.tools.assert_raises(requests.exceptions.ChunkedEncodingError, t.send,
+                             'get', 'http://vivo.school.edu/')
+    assert not breaker.probing
+    nose.tools.assert_raises(KeyboardInterrupt, t.send, 'get', 'http://vivo.school.edu/')
+    assert not breaker.probing
+    assert t.send('get', 'http://vivo.school.edu/').status_code == 200
+    assert not breaker.open
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,163 @@
+"""
+Test Session logins, job polling and RDF sources without a
+VIVO instance.
+"""
+import cgi
+import os
+import threading
+from StringIO import StringIO
+from tempfile import NamedTemporaryFile
+
+import nose
+
+from rdflib import Graph
+
+os.environ.setdefault('VIVO_URL', 'http://vivo.school.edu/')
+
+from .models.vivo import iter_ntriples
+from . import web_client
+from .test_batches import FakeResponse, ntriples
+
+class ExpiringTransport(object):
+    """
+    Answers the first request of each of two threads with VIVO's
+    login page, once both have been sent.
+    """
+
+    def __init__(self):
+        self.logins = 0
+        self.sent = 0
+        self.condition = threading.Condition()
+
+    def send(self, method, url, operation=None, idempotent=False, **kwargs):
+        if url.endswith('authenticate'):
+            self.logins += 1
+            return FakeResponse('')
+        with self.condition:
+            self.sent += 1
+            self.condition.notify_all()
+            if self.sent > 2:
+                return FakeResponse('ok')
+            while self.sent < 2:
+                self.condition.wait()
+        resp = FakeResponse('')
+        resp.history = [FakeResponse('', 302)]
+        resp.url = 'http://vivo.school.edu/authenticate'
+        return resp
+
+def test_relogin_once():
+    session = web_client.Session(url='http://vivo.school.edu/')
+    session.transport = ExpiringTransport()
+    session.login('vivo_root@school.edu', 'secret')
+    pages = []
+    workers = [
+        threading.Thread(target=lambda: pages.append(session.request('get', 'individual')))
+        for n in range(2)
+    ]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    #Both threads found the login expired; only one logged in again.
+    assert session.transport.logins == 2
+    assert [p.content for p in pages] == ['ok', 'ok']
+
+def test_shared_sessions():
+    login = web_client.Session.login
+    web_client.Session.login = lambda self, username=None, password=None: \
+        setattr(self, 'logged_in', True)
+    try:
+        a = web_client.get_session('http://vivo.school.edu/', 'a@school.edu', 'secret')
+        b = web_client.get_session('http://vivo.school.edu/', 'b@school.edu', 'secret')
+        assert a is not b
+        assert web_client.get_session('http://vivo.school.edu/', 'a@school.edu') is a
+    finally:
+        web_client.Session.login = login
+        web_client._shared_sessions.clear()
+
+def test_wait_until_idle():
+    pages = [
+        'Rebuilding the index. Completed 1,200 of 5,400 URIs.',
+        'Rebuilding the index. Completed 4,000 of 5,400 URIs.',
+        'The search indexer is idle.',
+    ]
+    session = web_client.Session(url='http://vivo.school.edu/')
+    session.request = lambda method, path, **kwargs: FakeResponse(pages.pop(0))
+    seen = []
+    status = web_client.wait_until_idle(web_client.index_status, session,
+                                        interval=0, progress=seen.append)
+    assert not status.running
+    assert [(s.done, s.total) for s in seen[:2]] == [(1200, 5400), (4000, 5400)]
+    pages = ['The system is currently in the process of recomputing inferences.'] * 3
+    nose.tools.assert_raises(Exception, web_client.wait_until_idle,
+                             web_client.recompute_status, session,
+                             interval=0, timeout=-1, progress=None)
+    #An idle page is not taken as done before the job is seen to start.
+    pages = ['The search indexer has been idle since 10:00.'] * 2
+    before = web_client.index_status(session)
+    nose.tools.assert_raises(Exception, web_client.wait_until_idle,
+                             web_client.index_status, session, before=before,
+                             interval=0, start_timeout=-1, progress=None)
+    pages = ['The search indexer has been idle since 10:05.']
+    status = web_client.wait_until_idle(web_client.index_status, session,
+                                        before=before, interval=0, progress=None)
+    assert status.message == 'The search indexer has been idle since 10:05'
+    #A recompute that finished before the first check has no marker to
+    #show it; it is taken as finished once start_timeout has passed.
+    pages = ['<input type="submit" value="Recompute Inferences"/>'] * 2
+    before = web_client.recompute_status(session)
+    status = web_client.wait_until_idle(web_client.recompute_status, session,
+                                        before=before, interval=0, start_timeout=-1,
+                                        progress=None)
+    assert not status.running
+
+def test_multipart_stream():
+    g = Graph()
+    g.parse(data=ntriples, format='n3')
+    pieces = list(web_client.multipart_stream(
+        'xyz', {'mode': 'remove'}, 'rdfStream', 'stream.nt', iter_ntriples(g)))
+    #Lines are sent together, not one chunk per triple.
+    assert len(pieces) == 1
+    body = ''.join(pieces)
+    pieces = list(web_client.multipart_stream(
+        'xyz', {}, 'rdfStream', 'stream.nt', iter_ntriples(g), chunk_size=100))
+    assert len(pieces) == 3
+    assert ''.join(pieces).count('rdf-schema#label') == 3
+    form = cgi.parse_multipart(StringIO(body), {'boundary': 'xyz'})
+    assert form['mode'] == ['remove']
+    posted = Graph()
+    posted.parse(data=form['rdfStream'][0], format='nt')
+    assert len(posted) == 3
+    assert set(posted) == set(g)
+
+def test_rdf_source():
+    g = Graph()
+    g.parse(data=ntriples, format='n3')
+    with NamedTemporaryFile(suffix='.n3') as f:
+        assert web_client.is_path(f.name)
+    assert not web_client.is_path(ntriples)
+    #One statement without a newline is data, not a path.
+    line = '<http://vivo.school.edu/a> <http://vivo.school.edu/b> "c" .'
+    assert not web_client.is_path(line)
+    name, format, data = web_client.rdf_source(line, 'N-TRIPLE')
+    assert data == line
+    assert not web_client.is_path('ex:a ex:b "c" .')
+    #A missing file is not posted as data.
+    assert web_client.is_path('/tmp/does-not-exist.n3')
+    session = web_client.Session(url='http://vivo.school.edu/')
+    session.logged_in = True
+    nose.tools.assert_raises(IOError, session.add_rdf, '/tmp/does-not-exist.n3')
+    name, format, data = web_client.rdf_source(ntriples, 'N3')
+    assert (format, data) == ('N3', ntriples)
+    name, format, data = web_client.rdf_source(g, 'N3')
+    assert format == 'N-TRIPLE'
+    assert len(list(data)) == 3
+    name, format, data = web_client.rdf_source(iter(g), 'N3')
+    assert format == 'N-TRIPLE'
+    assert len(list(data)) == 3
+    name, format, data = web_client.rdf_source(StringIO(ntriples), 'N3', chunk_size=10)
+    assert ''.join(data) == ntriples
+
+
+if __name__ == '__main__':
+    nose.main()
@@ -0,0 +1,233 @@
+"""
+HTTP transport shared by every request made to the VIVO web app.
+
+Adds to a requests session:
+
+* a timeout per kind of operation, so a stalled upload or query
+  can't hang a worker,
+* retries with exponential backoff for requests that are safe to
+  send again,
+* a circuit breaker that pauses all callers once VIVO stops
+  answering and lets one probe request through at a time until it
+  is back.
+
+Re-login on an expired session is handled by web_client.Session,
+which sends its requests through a Transport.
+
+"""
+import random
+import threading
+import time
+import types
+
+import requests
+
+#logging
+import logging
+_logger = logging.getLogger(__name__)
+
+#Seconds to wait for a connection to VIVO.
+CONNECT_TIMEOUT = 10
+#Seconds to wait for a response, by operation.
+TIMEOUTS = {
+    'login': 60,
+    'query': 600,
+    'upload': 3600,
+    'merge': 300,
+    'admin': 300,
+    'default': 120,
+}
+#Attempts after the first for requests that can be retried.
+RETRIES = 4
+#First and longest delay, in seconds, between attempts.
+BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+#Responses meaning VIVO, or the proxy in front of it, is not serving.
+UNAVAILABLE = (502, 503, 504)
+#Consecutive failures that open the circuit, and seconds it stays open.
+FAILURE_THRESHOLD = 5
+RESET_AFTER = 30.0
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to VIVO after threshold consecutive failures.
+
+    While open, callers block in before until reset_after seconds
+    have passed.  One caller is then let through as a probe; the
+    circuit closes when it succeeds and opens again when it fails.
+    Callers waiting longer than max_wait seconds get CircuitOpen.
+    """
+
+    def __init__(self, threshold=FAILURE_THRESHOLD, reset_after=RESET_AFTER,
+                 max_wait=None):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.max_wait = max_wait
+        self.failures = 0
+        self.opened = None
+        self.probing = False
+        self.condition = threading.Condition()
+
+    @property
+    def open(self):
+        return self.opened is not None
+
+    def before(self):
+        """
+        Wait until a request may be sent.
+        """
+        deadline = None
+        if self.max_wait is not None:
+            deadline = time.time() + self.max_wait
+        with self.condition:
+            while self.opened is not None:
+                now = time.time()
+                wait = self.opened + self.reset_after - now
+                if (wait <= 0) and (not self.probing):
+                    self.probing = True
+                    return
+                if wait <= 0:
+                    wait = self.reset_after
+                if deadline is not None:
+                    if now >= deadline:
+                        raise CircuitOpen("VIVO has not answered for %.0f seconds." %
+                                          (now - self.opened))
+                    wait = min(wait, deadline - now)
+                self.condition.wait(wait)
+
+    def success(self):
+        with self.condition:
+            if self.opened is not None:
+                _logger.info("VIVO is answering again.  Resuming requests.")
+            self.failures = 0
+            self.opened = None
+            self.probing = False
+            self.condition.notify_all()
+
+    def failure(self):
+        with self.condition:
+            self.failures += 1
+            self.probing = False
+            if self.failures >= self.threshold:
+                if self.opened is None:
+                    _logger.warning("VIVO not answering after %d attempts.  Pausing requests for %.0f seconds." %
+                                    (self.failures, self.reset_after))
+                self.opened = time.time()
+            self.condition.notify_all()
+
+    def abandon(self):
+        """
+        The request let through by before ended without a verdict on
+        VIVO, e.g. it was interrupted.  Let another caller probe.
+        """
+        with self.condition:
+            self.probing = False
+            self.condition.notify_all()
+
+
+def backoff_delay(attempt, base=BACKOFF, maximum=MAX_BACKOFF):
+    """
+    Exponential delay before retry number attempt, with jitter so
+    threads retrying together spread out.
+    """
+    delay = min(maximum, base * (2 ** (attempt - 1)))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def rewind(files):
+    """
+    Seek multipart file objects back to the start so a request
+    can be sent again.
+    """
+    for value in (files or {}).values():
+        if isinstance(value, tuple):
+            value = value[1]
+        if hasattr(value, 'seek'):
+            value.seek(0)
+
+
+def can_resend(kwargs):
+    """
+    False when the request body is generated as it is sent and
+    can't be read again.
+    """
+    return not isinstance(kwargs.get('data'), types.GeneratorType)
+
+
+class Transport(object):
+    """
+    Sends requests over a requests session with timeouts, retries
+    and a circuit breaker.
+    """
+
+    def __init__(self, session, timeouts=None, retries=RETRIES, backoff=BACKOFF,
+                 breaker=None):
+        self.session = session
+        self.timeouts = dict(TIMEOUTS)
+        self.timeouts.update(timeouts or {})
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+
+    def timeout(self, operation=None):
+        """
+        (connect, read) timeout for an operation.
+        """
+        read = self.timeouts.get(operation, self.timeouts['default'])
+        return (min(CONNECT_TIMEOUT, read), read)
+
+    def send(self, method, url, operation=None, idempotent=False, **kwargs):
+        """
+        Send a request.  Requests that are idempotent are retried
+        after timeouts, dropped connections and 502, 503 and 504
+        responses.  Others are only retried when VIVO can't have
+        seen them: a connection that was never made or a 503.
+        """
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout(operation)
+        attempt = 0
+        while True:
+            self.breaker.before()
+            try:
+                resp = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout), e:
+                self.breaker.failure()
+                safe = idempotent or isinstance(e, requests.exceptions.ConnectTimeout)
+                if not self.retry(attempt, safe, kwargs):
+                    raise
+                reason = e
+            except requests.exceptions.RequestException:
+                #Broken responses, redirect loops and the like.
+                self.breaker.failure()
+                raise
+            except BaseException:
+                #Errors from a streamed body, interrupts: never leave
+                #the breaker waiting on a probe that won't report back.
+                self.breaker.abandon()
+                raise
+            else:
+                if resp.status_code not in UNAVAILABLE:
+                    self.breaker.success()
+                    return resp
+                self.breaker.failure()
+                safe = idempotent or (resp.status_code == 503)
+                if not self.retry(attempt, safe, kwargs):
+                    return resp
+                resp.close()
+                reason = 'HTTP %d' % resp.status_code
+            attempt += 1
+            delay = backoff_delay(attempt, self.backoff)
+            _logger.warning("%s %s failed (%s).  Retry %d of %d in %.1fs." % (
+                method.upper(), url, reason, attempt, self.retries, delay))
+            time.sleep(delay)
+
+    def retry(self, attempt, safe, kwargs):
+        if (not safe) or (attempt >= self.retries) or (not can_resend(kwargs)):
+            return False
+        rewind(kwargs.get('files'))
+        return True
@@ -11,28 +11,356 @@ Writing directly to the models with Jena doesn't allow for that.
 import optparse
 import os
 import sys
+import itertools
+import re
+import threading
+import time
 import urllib
+import uuid
 
 import requests
+import requests.adapters
+
+from rdflib import Graph
+
+from merge import merge_pairs, read_pairs
+from models.vivo import iter_ntriples
+from transport import Transport, backoff_delay, can_resend, rewind
 
 #logging
 import logging
 _logger = logging.getLogger(__name__)
 
+#Default number of pooled connections per Session.
+POOL_SIZE = 10
+#Bytes read at a time when streaming file-like RDF sources.
+CHUNK_SIZE = 64 * 1024
+#Default number of statements posted per uploadRDF request in bulk mode.
+BATCH_SIZE = 10000
+#uploadRDF modes for bulk loading.
+BULK_MODES = {
+    'add': 'directAddABox',
+    'remove': 'remove',
+}
+#Bounds and target request latency, in seconds, for adaptive batching.
+MIN_BATCH_SIZE = 500
+MAX_BATCH_SIZE = 100000
+TARGET_LATENCY = 30.0
+#Times a batch that failed with a server error is retried, smaller,
+#by an adaptive bulk load.
+BATCH_RETRIES = 3
+#VIVO languages with one statement per line that can be split
+#into batches without parsing.
+LINE_FORMATS = ('N-TRIPLE', 'N-TRIPLES', 'NT')
+
+#Statement counts on the uploadRDF result page,
+#e.g. "Removed RDF from file post_sample.n3. Removed 1 statements."
+UPLOAD_COUNT = re.compile(r'(Added|Removed)\s+(\d+)\s+statements', re.IGNORECASE)
+#uploadRDF returns a 200 when a load fails, with a message such as
+#"Could not load from file: ... org.xml.sax.SAXParseException: ..."
+UPLOAD_ERROR = re.compile(r'(Could not (?:load|remove)[^<]*|[\w.]+(?:Exception|Error):[^<]*)')
+
+#Seconds before the first check of the admin pages for a background
+#job, and the longest wait between checks as the wait backs off.
+POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 60
+#Longest wait for a background job to finish, and for a job just
+#submitted to show on its admin page.
+WAIT_TIMEOUT = 12 * 60 * 60
+START_TIMEOUT = 5 * 60
+#RecomputeInferences page text while the reasoner is recomputing.
+RECOMPUTE_RUNNING = re.compile(r'in the process of recomputing', re.IGNORECASE)
+#SearchIndex page text once the indexer has nothing to do, e.g.
+#"The search indexer has been idle since ...".
+INDEX_IDLE = re.compile(r'[^<>.]*\bidle\b[^<>.]*', re.IGNORECASE)
+#Counts shown while a job works, e.g. "Completed 1200 of 5400 URIs".
+JOB_PROGRESS = re.compile(r'(\d[\d,]*)\s+(?:of|out of)\s+(\d[\d,]*)', re.IGNORECASE)
+#A single line of RDF given to add_rdf or remove_rdf instead of a path:
+#an IRI, blank node or directive first, or a statement ending in a period.
+RDF_LINE = re.compile(r'\s*(?:<|_:|@|\S+\s+\S+\s+\S.*\.\s*$)')
+#Parts of an N-Triples line; a # outside IRIs and literals starts a comment.
+NTRIPLES_PART = re.compile(r'<[^>]*>|"(?:[^"\\]|\\.)*"|#.*|[^<"#]+|.', re.DOTALL)
+
+#Callables run after a Session changes data in VIVO.
+_change_listeners = []
+
+
+def add_change_listener(func):
+    """
+    Register func to be called, without arguments, whenever RDF
+    is added or removed or individuals are merged.  Used to
+    invalidate cached query results.
+    """
+    _change_listeners.append(func)
+
+
+def notify_change():
+    for func in list(_change_listeners):
+        func()
+
+
+class UploadError(Exception):
+    """
+    uploadRDF failed, either with an HTTP error or a load error
+    reported on the result page.  The UploadResult is kept as result.
+    """
+
+    def __init__(self, message, result):
+        Exception.__init__(self, message)
+        self.result = result
+
+
+class UploadResult(object):
+    """
+    Outcome of one uploadRDF post as reported by VIVO.
+    """
+
+    def __init__(self, name, mode, status_code=None, added=None, removed=None,
+                 error=None, elapsed=0.0, skipped=False):
+        self.name = name
+        self.mode = mode
+        self.status_code = status_code
+        self.added = added
+        self.removed = removed
+        self.error = error
+        self.elapsed = elapsed
+        self.skipped = skipped
+
+    def __repr__(self):
+        if self.ok:
+            return '<UploadResult %s %s %d statements %.2fs>' % (
+                self.name, self.mode, self.statements, self.elapsed)
+        return '<UploadResult %s %s failed: %s>' % (self.name, self.mode, self.error)
+
+    @property
+    def ok(self):
+        return self.skipped or ((self.status_code == 200) and (self.error is None))
+
+    def __nonzero__(self):
+        return self.ok
+
+    @property
+    def statements(self):
+        """
+        Statements VIVO reported adding or removing.
+        """
+        return (self.added or 0) + (self.removed or 0)
+
+
+def parse_upload_response(resp, name, mode, elapsed=0.0):
+    """
+    Read statement counts and any load error from an uploadRDF
+    response.
+    """
+    result = UploadResult(name, mode, status_code=resp.status_code, elapsed=elapsed)
+    body = resp.content or ''
+    for verb, count in UPLOAD_COUNT.findall(body):
+        if verb.lower() == 'added':
+            result.added = (result.added or 0) + int(count)
+        else:
+            result.removed = (result.removed or 0) + int(count)
+    if resp.status_code != 200:
+        result.error = 'HTTP %d' % resp.status_code
+    else:
+        match = UPLOAD_ERROR.search(body)
+        if match is not None:
+            result.error = ' '.join(match.group(1).split())
+    return result
+
+
+class UploadMetrics(object):
+    """
+    Running totals for the uploads made through a Session, so
+    throughput drops and failing batches show up during a bulk run.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.started = None
+            self.finished = None
+            self.uploads = 0
+            self.failures = 0
+            self.skipped = 0
+            self.added = 0
+            self.removed = 0
+            self.seconds = 0.0
+            self.errors = []
+
+    def record(self, result):
+        now = time.time()
+        with self.lock:
+            if self.started is None:
+                self.started = now - result.elapsed
+            self.finished = now
+            self.uploads += 1
+            self.seconds += result.elapsed
+            if result.skipped:
+                self.skipped += 1
+            elif not result.ok:
+                self.failures += 1
+                self.errors.append((result.name, result.error))
+            self.added += result.added or 0
+            self.removed += result.removed or 0
+
+    @property
+    def statements(self):
+        return self.added + self.removed
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return self.finished - self.started
+
+    @property
+    def statements_per_second(self):
+        if not self.elapsed:
+            return 0.0
+        return self.statements / self.elapsed
+
+    @property
+    def failure_rate(self):
+        if not self.uploads:
+            return 0.0
+        return float(self.failures) / self.uploads
+
+    def stats(self):
+        return {
+            'uploads': self.uploads,
+            'failures': self.failures,
+            'skipped': self.skipped,
+            'added': self.added,
+            'removed': self.removed,
+            'elapsed': self.elapsed,
+            'request_seconds': self.seconds,
+            'statements_per_second': self.statements_per_second,
+            'failure_rate': self.failure_rate,
+        }
+
+    def summary(self):
+        return "%d uploads, %d failed, %d skipped: %d added, %d removed in %.1fs (%.0f statements/s)." % (
+            self.uploads, self.failures, self.skipped, self.added, self.removed,
+            self.elapsed, self.statements_per_second)
+
+
+class AdaptiveBatchSize(object):
+    """
+    Tunes uploadRDF batch size and concurrency from how VIVO responds.
+
+    Batches grow by step statements, and uploads in flight by one,
+    while requests finish within target seconds.  Slow requests and
+    server errors halve the batch size and drop one upload in flight,
+    at most once per target seconds, so a burst of slow responses to
+    requests already in flight counts as one signal.  Upload threads
+    call acquire and release around each post and wait while the
+    number in flight is at the current limit.
+    """
+
+    def __init__(self, size=BATCH_SIZE, minimum=MIN_BATCH_SIZE, maximum=MAX_BATCH_SIZE,
+                 target=TARGET_LATENCY, step=None, workers=1, max_workers=1):
+        self.minimum = min(minimum, size)
+        self.maximum = max(maximum, size)
+        self.size = size
+        self.step = step or max(1, self.size / 4)
+        self.target = target
+        self.workers = workers
+        self.max_workers = max(workers, max_workers)
+        self.active = 0
+        self.backed_off = 0
+        self.condition = threading.Condition()
+
+    def __repr__(self):
+        return '<AdaptiveBatchSize %d statements, %d workers>' % (self.size, self.workers)
+
+    def acquire(self):
+        with self.condition:
+            while self.active >= self.workers:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    def observe(self, seconds, error=False):
+        """
+        Adjust to the latency of one upload, or to a failed one.
+        """
+        with self.condition:
+            now = time.time()
+            if error or (seconds > self.target):
+                if now - self.backed_off < self.target:
+                    return
+                self.backed_off = now
+                self.size = max(self.minimum, self.size / 2)
+                self.workers = max(1, self.workers - 1)
+                _logger.info("VIVO slowing down (%.1fs%s).  Backing off to %r." % (
+                    seconds, ', error' if error else '', self))
+            else:
+                self.size = min(self.maximum, self.size + self.step)
+                if (seconds < self.target / 2) and (self.workers < self.max_workers):
+                    self.workers += 1
+                    self.condition.notify_all()
+                _logger.debug("VIVO keeping up (%.1fs).  %r." % (seconds, self))
+
+
+def server_error(error):
+    """
+    True for upload failures worth retrying with a smaller batch:
+    5xx responses, timeouts and dropped connections.
+    """
+    if isinstance(error, UploadError):
+        return (error.result.status_code or 0) >= 500
+    return isinstance(error, (requests.exceptions.Timeout,
+                              requests.exceptions.ConnectionError))
+
 
 class Session(object):
 
     def __init__(self, **kwargs):
         self.session = requests.session()
-        self.url = kwargs.get('url') or self._get_vivo_url()
+        self.set_pool_size(kwargs.get('pool_size', POOL_SIZE))
+        #Timeouts, retries and circuit breaker, see transport.
+        self.transport = Transport(
+            self.session,
+            timeouts=kwargs.get('timeouts'),
+            breaker=kwargs.get('breaker')
+        )
+        self.url = kwargs.get('url') or vivo_url()
         self.logged_in = False
+        self.credentials = (None, None)
+        #Logins so far; threads that find the login expired together
+        #log in once, see request.
+        self.logins = 0
+        self.login_lock = threading.Lock()
+        #Optional ledger.UploadLedger; content already uploaded
+        #with the same mode is skipped.
+        self.ledger = kwargs.get('ledger')
+        self.metrics = UploadMetrics()
+
+    def set_pool_size(self, size):
+        """
+        Number of keep-alive connections kept open to VIVO.  Should
+        be at least the number of threads sharing this session.
+        """
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=size,
+            pool_maxsize=size
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool_size = size
 
     def _get_vivo_url(self):
         """Helper to make sure trailing slash
         is found in VIVO url.
         """
-        vurl = os.getenv('VIVO_URL').rstrip('/') + '/'
-        return vurl
+        return vivo_url()
 
     def login(self, username=None, password=None):
         """
@@ -45,18 +373,50 @@ class Session(object):
         }
         if (payload['loginName'] is None) or (payload['loginPassword'] is None):
             raise Exception("No username or password provided for VIVO web app.")
-        self.session.post(
+        self.transport.send(
+            'post',
             self.url + 'authenticate',
+            operation='login',
+            idempotent=True,
             data=payload,
             verify=False
         )
         self.logged_in = True
+        self.credentials = (username, password)
+        self.logins += 1
+
+    def request(self, method, path, operation=None, idempotent=False, **kwargs):
+        """
+        Send a request to a path relative to the VIVO url through the
+        transport, with the timeout for operation ('query', 'upload',
+        'merge', 'admin').  Set idempotent when the request is safe
+        to repeat after a timeout or a dropped connection.
+
+        If VIVO has expired the login cookie and redirects to the
+        login page, log in again and repeat the request once.
+        """
+        kwargs.setdefault('verify', False)
+        url = self.url + path
+        logins = self.logins
+        resp = self.transport.send(method, url, operation, idempotent, **kwargs)
+        if self.logged_in and login_expired(resp):
+            if not can_resend(kwargs):
+                raise Exception("VIVO session expired during a streamed upload.  Log in and upload again.")
+            with self.login_lock:
+                #Another thread may have logged in since this request was sent.
+                if self.logins == logins:
+                    _logger.info("VIVO session expired.  Logging in again.")
+                    self.login(*self.credentials)
+            rewind(kwargs.get('files'))
+            resp = self.transport.send(method, url, operation, idempotent, **kwargs)
+        return resp
 
     def logout(self):
         """
         End the VIVO web session.
         """
-        resp = self.session.get(self.url + 'logout', verify=False)
+        resp = self.transport.send('get', self.url + 'logout', operation='login',
+                                   idempotent=True, verify=False)
         #Check response history for logout.
         logout_resp = resp.history[0]
         if logout_resp.status_code == 302:
@@ -65,59 +425,263 @@ class Session(object):
         else:
             raise Exception('Logout failed.')
 
+    def uploaded(self, mode, digest, name, graph=None):
+        """
+        Check the ledger for content already uploaded with mode.
+        Returns a skipped UploadResult, or None if it should be posted.
+        """
+        if (self.ledger is None) or (not self.ledger.seen(self.url, graph, mode, digest)):
+            return None
+        _logger.info("Skipping %s.  Already uploaded (%s) to %s." % (name, mode, self.url))
+        result = UploadResult(name, mode, skipped=True)
+        self.metrics.record(result)
+        return result
+
+    def record_upload(self, mode, digest, name, graph=None):
+        if (self.ledger is not None) and (digest is not None):
+            self.ledger.record(self.url, graph, mode, digest, name)
+
+    def post_upload(self, name, mode, idempotent=None, **kwargs):
+        """
+        Post to uploadRDF and check the result page.  Returns an
+        UploadResult; raises UploadError if VIVO did not load the data.
+
+        Uploads are only retried after a timeout or dropped connection
+        when idempotent is set, or by default when the session keeps a
+        ledger, which records the upload once it is acknowledged.
+        """
+        if idempotent is None:
+            idempotent = self.ledger is not None
+        start = time.time()
+        resp = self.request('post', 'uploadRDF', operation='upload',
+                            idempotent=idempotent, **kwargs)
+        result = parse_upload_response(resp, name, mode, time.time() - start)
+        self.metrics.record(result)
+        if self.ledger is not None:
+            #Even a failed load may have changed some statements.
+            self.ledger.invalidate(self.url, mode)
+        if not result.ok:
+            raise UploadError('Error posting %s (%s): %s.  Check Vivo log.\n%s' % (
+                name, mode, result.error, resp.content), result)
+        _logger.debug(repr(result))
+        notify_change()
+        return result
+
+    def stream_rdf(self, mode, chunks, format, name='stream.nt'):
+        """
+        Post an iterable of encoded RDF chunks, such as the output of
+        models.vivo.iter_ntriples, to uploadRDF.  The multipart body is
+        sent with chunked encoding as it is generated, so nothing is
+        written to disk or held in memory.
+        """
+        if self.logged_in != True:
+            raise Exception("VIVO session not created.  Need to call login.")
+        boundary = uuid.uuid4().hex
+        fields = dict(
+            mode=mode,
+            language=format,
+            submit='submit',
+        )
+        result = self.post_upload(
+            name,
+            mode,
+            data=multipart_stream(boundary, fields, 'rdfStream', name, chunks),
+            headers={
+                'Content-Type': 'multipart/form-data; boundary=%s' % boundary,
+                'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3'
+            }
+        )
+        _logger.info("Streamed %s (%s) to %s." % (name, mode, self.url))
+        return result
+
+    def upload_source(self, mode, source, format):
+        """
+        Post RDF that is not a file path (see rdf_source): string
+        data as one batch, anything else streamed.
+        """
+        name, format, data = rdf_source(source, format)
+        if isinstance(data, str):
+            return self.post_batch(mode, name, data, format)
+        return self.stream_rdf(mode, data, format, name=name)
+
     def add_rdf(self, file_path, format='N3'):
+        """
+        Add RDF from file_path.  Instead of a path, RDF data can be
+        given as a string, an rdflib Graph, a file-like object, an
+        iterable of triples or an iterable of encoded chunks.  These
+        are posted without writing a temporary file.
+        """
+        if not is_path(file_path):
+            return self.upload_source('directAddABox', file_path, format)
         if self.logged_in != True:
             raise Exception("VIVO session not created.  Need to call login.")
         filename, extension = get_name_extension(file_path)
         base_url = self.url
+        digest = None
+        if self.ledger is not None:
+            digest = self.ledger.file_hash(file_path, format)
+            skipped = self.uploaded('directAddABox', digest, file_path)
+            if skipped:
+                return skipped
         payload = dict(
             language=format,
             submit='submit',
             #action='loadRDFData',
             mode='directAddABox'
         )
-        resp = self.session.post(
-            base_url + 'uploadRDF',
-            verify=False,
-            data=payload,
-            files={'rdfStream': (filename, open(file_path, 'rb'))}
-        )
-        #All posts seem to return a 200.  Should check for messages that
-        #indicate something went wrong.
-        #Success: RDF upload successful.
-        #Error: Could not load from file:
-        #edu.cornell.mannlib.vitro.webapp.rdfservice.
-        #RDFServiceException: com.hp.hpl.jena.shared.JenaException:
-        #org.xml.sax.SAXParseException: The element type "link"
-        #must be terminated by the matching end-tag "".
-        _logger.info("Adding %s to %s." % (file_path, base_url))
-        if resp.status_code != 200:
-            raise Exception('Error adding RDF.  Check Vivo log.\n%s' % resp.content)
-        return True
+        #All posts return a 200.  post_upload checks the page for
+        #load errors, see UPLOAD_ERROR.
+        with open(file_path, 'rb') as f:
+            result = self.post_upload(
+                file_path,
+                'directAddABox',
+                data=payload,
+                files={'rdfStream': (filename, f)}
+            )
+        _logger.info("Added %s to %s (%s statements)." % (file_path, base_url, result.added))
+        self.record_upload('directAddABox', digest, file_path)
+        return result
 
     def remove_rdf(self, file_path, format='N3'):
+        """
+        Remove RDF in file_path.  Accepts the same sources as add_rdf.
+        """
+        if not is_path(file_path):
+            return self.upload_source('remove', file_path, format)
         if self.logged_in != True:
             raise Exception("VIVO session not created.  Need to call login.")
         filename, extension = get_name_extension(file_path)
         base_url = self.url
+        digest = None
+        if self.ledger is not None:
+            digest = self.ledger.file_hash(file_path, format)
+            skipped = self.uploaded('remove', digest, file_path)
+            if skipped:
+                return skipped
         payload = dict(
             mode='remove',
             language=format,
             submit='submit',
         )
-        p = self.session.post(
-            base_url + 'uploadRDF',
-            verify=False,
+        with open(file_path, 'rb') as f:
+            result = self.post_upload(
+                file_path,
+                'remove',
+                data=payload,
+                files={'rdfStream': (filename, f)},
+                headers={'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3'}
+            )
+        _logger.info("Removed %s from %s (%s statements)." % (file_path, base_url, result.removed))
+        self.record_upload('remove', digest, file_path)
+        return result
+
+    def post_batch(self, mode, name, data, format, idempotent=None,
+                   use_ledger=True):
+        """
+        Post one in-memory batch of statements to uploadRDF.
+        Returns an UploadResult.  See post_upload for idempotent.
+        With use_ledger False the batch is always posted and not
+        recorded, e.g. for deltas computed from VIVO's current state.
+        """
+        digest = None
+        if (self.ledger is not None) and use_ledger:
+            digest = self.ledger.data_hash(data, format)
+            skipped = self.uploaded(mode, digest, name)
+            if skipped:
+                return skipped
+        payload = dict(
+            mode=mode,
+            language=format,
+            submit='submit',
+        )
+        result = self.post_upload(
+            name,
+            mode,
+            idempotent=idempotent,
             data=payload,
-            files={'rdfStream': (filename, open(file_path, 'rb'))},
+            files={'rdfStream': (name, data)},
             headers={'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3'}
         )
-        _logger.info("Removing %s from %s." % (file_path, base_url))
-        #Here we can actually look for this text:
-        #Removed RDF from file post_sample.n3. Removed 1 statements.
-        if p.status_code != 200:
-            raise Exception('Error removing RDF.  Check Vivo log.\n%s' % p.content)
-        return True
+        self.record_upload(mode, digest, name)
+        return result
+
+    def bulk_load(self, file_path, mode='add', batch_size=BATCH_SIZE,
+                  format='N-TRIPLE', checkpoint=None, adaptive=None,
+                  retries=BATCH_RETRIES):
+        """
+        Stream a line based RDF file (N-Triples) to VIVO in batches of
+        batch_size statements.  Only one batch is held in memory at a time.
+
+        mode is 'add' or 'remove'.  If checkpoint is a file path, the
+        number of statements VIVO acknowledged is recorded there after
+        each post and statements acknowledged by a previous, failed
+        run are skipped.  The checkpoint is removed once the whole
+        file has been loaded.
+
+        adaptive is an optional AdaptiveBatchSize that sets the size
+        of each batch instead of batch_size.  A batch that fails with
+        a server error is then retried up to retries times, after the
+        transport's backoff delay, each time cut to at most half its
+        size.
+
+        Returns the number of batches posted.
+        """
+        if self.logged_in != True:
+            raise Exception("VIVO session not created.  Need to call login.")
+        if mode not in BULK_MODES:
+            raise Exception("Unknown bulk mode %s.  Options are add, remove." % mode)
+        if format.upper() not in LINE_FORMATS:
+            raise Exception("Bulk loading requires N-Triples input, not %s." % format)
+        filename, extension = get_name_extension(file_path)
+        done = read_checkpoint(checkpoint)
+        statements = iter_statements(file_path)
+        if done:
+            _logger.info("Resuming %s after statement %d." % (file_path, done))
+            for _ in itertools.islice(statements, done):
+                pass
+        posted = 0
+        failures = 0
+        carry = []
+        limit = None
+        while True:
+            size = adaptive.size if adaptive else batch_size
+            if limit is not None:
+                size = min(size, limit)
+            batch, carry = carry[:size], carry[size:]
+            batch.extend(itertools.islice(statements, size - len(batch)))
+            if not batch:
+                break
+            name = '%s-%d.nt' % (filename, posted + 1)
+            start = time.time()
+            try:
+                result = self.post_batch(BULK_MODES[mode], name, ''.join(batch), format)
+            except Exception, e:
+                if (adaptive is None) or (not server_error(e)) or (failures >= retries):
+                    raise
+                adaptive.observe(time.time() - start, error=True)
+                failures += 1
+                #observe backs off at most once per target seconds, so
+                #cut the retry here too.
+                limit = max(1, len(batch) / 2)
+                delay = backoff_delay(failures, self.transport.backoff)
+                _logger.warning("Batch %s failed (%s).  Retrying %d statements in %.1fs." %
+                                (name, e, len(batch), delay))
+                carry = batch + carry
+                time.sleep(delay)
+                continue
+            if adaptive:
+                adaptive.observe(time.time() - start)
+            failures = 0
+            limit = None
+            posted += 1
+            done += len(batch)
+            _logger.info("Posted batch %d (%d statements, VIVO reported %d) of %s to %s." %
+                         (posted, len(batch), result.statements, file_path, self.url))
+            write_checkpoint(checkpoint, done)
+        if (checkpoint is not None) and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        _logger.info(self.metrics.summary())
+        return posted
 
     def merge(self, uri1, uri2):
         if self.logged_in != True:
@@ -128,13 +692,148 @@ class Session(object):
                   'uri2': uri2,
                   'usePrimaryLabelOnly': 'Use Primary Label Only',
                   'submit': 'Merge resources'}
-        merge = self.session.get(base_url + 'ingest', params=params)
+        merge = self.request('get', 'ingest', operation='merge', params=params)
         if merge.url == base_url + 'authenticate':
             raise Exception("Failed to login to VIVO.")
         if merge.status_code != 200:
             raise Exception("Merge failed; requests output: %s" % merge.content)
+        notify_change()
+        if self.ledger is not None:
+            self.ledger.forget(self.url)
         return True
 
+    def __enter__(self):
+        if self.logged_in != True:
+            self.login()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.logged_in:
+            self.logout()
+        return False
+
+
+def login_expired(response):
+    """
+    True when VIVO redirected a request to its login page.
+    """
+    if not response.history:
+        return False
+    path = response.url.split('?')[0].rstrip('/')
+    return path.endswith('/authenticate') or path.endswith('/login')
+
+
+def multipart_stream(boundary, fields, file_field, filename, chunks,
+                     chunk_size=CHUNK_SIZE):
+    """
+    Generate a multipart/form-data body with form fields followed
+    by one file part whose content is read from chunks.  Small
+    chunks, such as single N-Triples lines, are joined into pieces
+    of about chunk_size bytes; each piece is sent as one chunk of
+    the chunked request body.
+    """
+    buffered = []
+    for key, value in fields.items():
+        buffered.append('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' %
+                        (boundary, key, value))
+    buffered.append('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                    'Content-Type: application/octet-stream\r\n\r\n' % (boundary, file_field, filename))
+    size = sum(len(b) for b in buffered)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        buffered.append(chunk)
+        size += len(chunk)
+        if size >= chunk_size:
+            yield ''.join(buffered)
+            buffered = []
+            size = 0
+    buffered.append('\r\n--%s--\r\n' % boundary)
+    yield ''.join(buffered)
+
+
+def is_path(source):
+    """
+    True when an add_rdf or remove_rdf source is a file path rather
+    than RDF data.  Strings without a newline are paths unless they
+    name no file and read as a line of RDF, see RDF_LINE.  A mistyped
+    path then fails with an IOError when it is opened.
+    """
+    if (not isinstance(source, basestring)) or ('\n' in source):
+        return False
+    return os.path.exists(source) or (RDF_LINE.match(source) is None)
+
+
+def rdf_source(source, format, chunk_size=CHUNK_SIZE):
+    """
+    Resolve RDF given as a string, an rdflib Graph, a file-like
+    object, an iterable of triples or an iterable of encoded chunks.
+    Returns (name, format, data) where data is a string or an
+    iterator of encoded chunks.  Graphs and triples are written as
+    N-Triples as they are read.
+    """
+    if isinstance(source, unicode):
+        source = source.encode('utf-8')
+    if isinstance(source, (str, bytearray)):
+        return ('data.rdf', format, str(source))
+    if isinstance(source, Graph):
+        return ('graph.nt', 'N-TRIPLE', iter_ntriples(source))
+    if hasattr(source, 'read'):
+        name = os.path.basename(getattr(source, 'name', '') or 'stream.rdf')
+        return (name, format, iter(lambda: source.read(chunk_size), ''))
+    items = iter(source)
+    try:
+        first = items.next()
+    except StopIteration:
+        return ('empty.nt', format, '')
+    items = itertools.chain([first], items)
+    if isinstance(first, tuple):
+        return ('triples.nt', 'N-TRIPLE', iter_ntriples(items))
+    return ('stream.rdf', format, items)
+
+
+def vivo_url():
+    """
+    VIVO_URL with a trailing slash.
+    """
+    return os.getenv('VIVO_URL').rstrip('/') + '/'
+
+
+#Logged-in Sessions shared by the module level helpers, keyed by
+#VIVO url and user name.
+_shared_sessions = {}
+_shared_lock = threading.Lock()
+
+
+def get_session(url=None, username=None, password=None):
+    """
+    Return a logged-in Session for url (VIVO_URL by default) and
+    username (VIVO_USER by default) that is shared by the module
+    level helpers.  Authentication happens once; the Session logs in
+    again only when VIVO expires its cookie.
+    """
+    url = url or vivo_url()
+    key = (url, username or os.getenv('VIVO_USER'))
+    with _shared_lock:
+        s = _shared_sessions.get(key)
+        if s is None:
+            s = Session(url=url)
+            _shared_sessions[key] = s
+        if s.logged_in != True:
+            s.login(username, password)
+    return s
+
+
+def close_sessions():
+    """
+    Log out and forget all shared Sessions.
+    """
+    with _shared_lock:
+        while _shared_sessions:
+            key, s = _shared_sessions.popitem()
+            if s.logged_in:
+                s.logout()
+
 
 def get_name_extension(path):
     """
@@ -150,97 +849,155 @@ def get_name_extension(path):
     return (name, ext)
 
 
-def add_rdf(file_path, format='N3'):
+def strip_comment(line):
+    """
+    Line of N-Triples without a trailing comment.
+    """
+    parts = []
+    for part in NTRIPLES_PART.findall(line):
+        if part.startswith('#'):
+            break
+        parts.append(part)
+    return ''.join(parts).rstrip()
+
+
+def iter_statements(file_path):
+    """
+    Lazily read the statements of an N-Triples file, one line each.
+    Blank lines and comments are skipped.  A statement is only closed
+    by a line ending in a period, before any trailing comment, so
+    statements wrapped over several lines are joined.
+    """
+    pending = []
+    with open(file_path, 'rb') as f:
+        for line in f:
+            stripped = line.strip()
+            if (not pending) and ((stripped == '') or stripped.startswith('#')):
+                continue
+            pending.append(line.rstrip('\r\n'))
+            if not strip_comment(stripped).endswith('.'):
+                continue
+            yield ' '.join(pending) + '\n'
+            pending = []
+    if pending:
+        raise Exception("Unterminated statement at end of %s." % file_path)
+
+
+def iter_triple_batches(file_path, batch_size=BATCH_SIZE):
+    """
+    Lazily read an N-Triples file and yield lists of at most
+    batch_size statements, see iter_statements.  batch_size can be
+    an AdaptiveBatchSize, whose current size is used for each batch.
+    """
+    statements = iter_statements(file_path)
+    while True:
+        size = getattr(batch_size, 'size', batch_size)
+        batch = list(itertools.islice(statements, size))
+        if not batch:
+            break
+        yield batch
+
+
+def read_checkpoint(path):
+    """
+    Number of statements acknowledged by VIVO in a previous run.
+    """
+    if (path is None) or (not os.path.exists(path)):
+        return 0
+    with open(path) as f:
+        return int(f.read().strip() or 0)
+
+
+def write_checkpoint(path, number):
+    """
+    Record the statements acknowledged so far.  Written to a temporary
+    file and renamed so a crash never leaves a partial checkpoint.
+    """
+    if path is None:
+        return
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(str(number))
+    os.rename(tmp, path)
+
+
+def add_rdf(file_path, format='N3', session=None):
     filename, extension = get_name_extension(file_path)
-    vs = Session()
-    vs.login()
+    vs = session or get_session()
     base_url = vs.url
+    digest = None
+    if vs.ledger is not None:
+        digest = vs.ledger.file_hash(file_path, format)
+        skipped = vs.uploaded('loadRDFData', digest, file_path)
+        if skipped:
+            return skipped
     payload = dict(
         language=format,
         submit='Load Data',
         action='loadRDFData',
     )
-    resp = vs.session.post(
-        base_url + 'uploadRDF',
-        verify=False,
-        data=payload,
-        files={'rdfStream': (filename, open(file_path, 'rb'))}
-    )
-    #All posts seem to return a 200.  Should check for messages that
-    #indicate something went wrong.
-    #Success: RDF upload successful.
-    #Error: Could not load from file:
-    #edu.cornell.mannlib.vitro.webapp.rdfservice.
-    #RDFServiceException: com.hp.hpl.jena.shared.JenaException:
-    #org.xml.sax.SAXParseException: The element type "link"
-    #must be terminated by the matching end-tag "".
-    print>>sys.stderr, "Adding %s to %s." % (file_path, base_url)
-    if resp.status_code != 200:
-        raise Exception('Error adding RDF.  Check Vivo log.\n%s' % resp.content)
-    vs.logout()
-    return True
+    with open(file_path, 'rb') as f:
+        result = vs.post_upload(
+            file_path,
+            'loadRDFData',
+            data=payload,
+            files={'rdfStream': (filename, f)}
+        )
+    print>>sys.stderr, "Added %s to %s." % (file_path, base_url)
+    vs.record_upload('loadRDFData', digest, file_path)
+    return result
 
 
-def remove_rdf(file_path, format='N3'):
-    filename, extension = get_name_extension(file_path)
-    vs = Session()
-    vs.login()
-    base_url = vs.url
-    payload = dict(
-        mode='remove',
-        language=format,
-        submit='submit',
-    )
-    p = vs.session.post(
-        base_url + 'uploadRDF',
-        verify=False,
-        data=payload,
-        files={'rdfStream': (filename, open(file_path, 'rb'))},
-        headers={'Accept-Charset': 'ISO-8859-1,utf-8;q=0.7,*;q=0.3'}
-    )
-    print>>sys.stderr, "Removing %s from %s." % (file_path, base_url)
-    #Here we can actually look for this text:
-    #Removed RDF from file post_sample.n3. Removed 1 statements.
-    if p.status_code != 200:
-        raise Exception('Error removing RDF.  Check Vivo log.\n%s' % p.content)
-    vs.logout()
-    return True
+def remove_rdf(file_path, format='N3', session=None):
+    vs = session or get_session()
+    print>>sys.stderr, "Removing %s from %s." % (file_path, vs.url)
+    return vs.remove_rdf(file_path, format=format)
 
 
-def recompute_inferences(config):
+def recompute_inferences(config, session=None, wait=False, **kwargs):
     """
     -authenticate
     -post to address
     - look for text on returned page
+
+    With wait, block until the reasoner has finished and return the
+    final JobStatus.  Other keyword arguments go to wait_until_idle.
     """
-    vs = Session()
-    vs.login()
+    vs = session or get_session()
     base_url = vs.url
+    if wait:
+        kwargs['before'] = recompute_status(vs)
     #Recompute of inferences started. See vivo log for further details.
     print>>sys.stderr, 'Recomputing inferences for %s.' % base_url
-    r = vs.session.post(
-        base_url + 'RecomputeInferences',
+    r = vs.request(
+        'post',
+        'RecomputeInferences',
+        operation='admin',
         data={'submit': 'Recompute Inferences'}
     )
-    if r.content.find('Recompute of inferences started.\
-                    See vivo log for further details.') == -1:
+    if r.content.find('Recompute of inferences started.') == -1:
         raise Exception("Rebuilding inferences failed")
-    vs.logout()
+    if wait:
+        return wait_until_idle(recompute_status, vs, **kwargs)
     return True
 
 
-def rebuild_index(config):
+def rebuild_index(config, session=None, wait=False, **kwargs):
     """
     Logs into Vivo and submits a Rebuild Index command.
 
-    This tool does not wait for the index to finish rebuilding.
+    Unless wait is set, this does not wait for the index to finish
+    rebuilding.  With wait, block until the indexer is idle and
+    return the final JobStatus.  Other keyword arguments go to
+    wait_until_idle.
     """
-    s = Session()
-    s.login()
-    base_url = s.url
-    s = requests.session()
-    r = s.post(
-        base_url + 'SearchIndex',
+    s = session or get_session()
+    if wait:
+        kwargs['before'] = index_status(s)
+    r = s.request(
+        'post',
+        'SearchIndex',
+        operation='admin',
         data={
             'rebuild': 'Rebuild'
         }
@@ -249,32 +1006,123 @@ def rebuild_index(config):
     if r.content.find('the search index') == -1:
         raise Exception('Rebuilding search index failed.\
                 Check Vivo log and admin pages.')
-    s.logout()
+    if wait:
+        return wait_until_idle(index_status, s, **kwargs)
     return True
 
 
+class JobStatus(object):
+    """
+    State of a VIVO background job read from its admin page.
+    """
+
+    def __init__(self, name, running, done=None, total=None, message=None):
+        self.name = name
+        self.running = running
+        self.done = done
+        self.total = total
+        #Status text shown while idle, if the page has any.
+        self.message = message
+        self.elapsed = 0.0
+
+    def __repr__(self):
+        return '<JobStatus %s>' % self.describe()
+
+    def describe(self):
+        text = '%s %s' % (self.name, 'running' if self.running else 'finished')
+        if self.running and (self.total is not None):
+            text += ', %d of %d' % (self.done, self.total)
+        return '%s after %.0fs' % (text, self.elapsed)
+
+
+def job_status(name, content, running, message=None):
+    status = JobStatus(name, running, message=message)
+    match = JOB_PROGRESS.search(content)
+    if match is not None:
+        status.done, status.total = [int(n.replace(',', '')) for n in match.groups()]
+    return status
+
+
+def recompute_status(session=None):
+    """
+    JobStatus of the reasoner's recompute.
+    """
+    s = session or get_session()
+    r = s.request('get', 'RecomputeInferences', operation='admin', idempotent=True)
+    return job_status('recompute', r.content,
+                      RECOMPUTE_RUNNING.search(r.content) is not None)
+
+
+def index_status(session=None):
+    """
+    JobStatus of the search indexer, running while it is rebuilding
+    or processing changes.
+    """
+    s = session or get_session()
+    r = s.request('get', 'SearchIndex', operation='admin', idempotent=True)
+    idle = INDEX_IDLE.search(r.content)
+    if idle is None:
+        return job_status('search index', r.content, True)
+    return job_status('search index', r.content, False,
+                      ' '.join(idle.group(0).split()))
+
+
+def log_progress(status):
+    _logger.info(status.describe())
+
+
+def wait_until_idle(status, session=None, before=None, interval=POLL_INTERVAL,
+                    max_interval=MAX_POLL_INTERVAL, timeout=WAIT_TIMEOUT,
+                    start_timeout=START_TIMEOUT, progress=log_progress):
+    """
+    Poll status(session), e.g. index_status, until the job submitted
+    has finished.  The first check is made after interval seconds;
+    the wait between checks then doubles up to max_interval.
+    progress is called with each JobStatus, its elapsed seconds set.
+
+    VIVO may not have started the job by the first check, so an idle
+    page only counts once the job was seen running, or when its idle
+    message differs from before, the status read before submitting.
+    Pages without an idle message, such as RecomputeInferences, can't
+    tell a job that finished between checks from one not yet started;
+    they are taken as finished, with a warning, after start_timeout.
+
+    Returns the final JobStatus.  Raises an Exception if the job is
+    still running after timeout seconds, or was never seen to start
+    within start_timeout seconds although its page has a message.
+    """
+    start = time.time()
+    delay = interval
+    started = False
+    while True:
+        time.sleep(delay)
+        current = status(session)
+        current.elapsed = time.time() - start
+        if progress is not None:
+            progress(current)
+        if current.running:
+            started = True
+        elif started or ((before is not None) and (not before.running) and
+                         (current.message != before.message)):
+            return current
+        elif current.elapsed > start_timeout:
+            if current.message is None:
+                _logger.warning("VIVO %s not seen running within %d seconds.  It may have "
+                                "finished between checks." % (current.name, start_timeout))
+                return current
+            raise Exception("VIVO %s not seen running within %d seconds." %
+                            (current.name, start_timeout))
+        if (timeout is not None) and (current.elapsed > timeout):
+            raise Exception("VIVO %s still running after %d seconds." % (current.name, timeout))
+        delay = min(max_interval, delay * 2)
+
+
 def merge_individuals(uri1, uri2, session=None):
     """
     Use the merge tool to merge individual resources.
     """
-    if session is not None:
-        s = session
-    else:
-        s = Session()
-        s.login()
-    base_url = s.url
-    params = {'action': 'mergeResources',
-              'uri1': uri1,
-              'uri2': uri2,
-              'usePrimaryLabelOnly': 'Use Primary Label Only',
-              'submit': 'Merge resources'}
-    merge = s.session.get(base_url + 'ingest', params=params)
-    if merge.url == base_url + 'authenticate':
-        raise Exception("Failed to login to VIVO.")
-    if merge.status_code != 200:
-        raise Exception("Merge failed; requests output: %s" % merge.content)
-    s.logout()
-    return True
+    s = session or get_session()
+    return s.merge(uri1, uri2)
 
 
 def created_named_graph(name, session=None):
@@ -282,19 +1130,17 @@ def created_named_graph(name, session=None):
     modelName:http://localhost/staged
     submit:Create Model
     modelType:sdb"""
-    s = Session()
-    s.login()
+    s = session or get_session()
     params = {
         'action': 'createModel',
         'modelName': name,
         'submit': 'Create Model',
         'modelType': 'sdb',
     }
-    r = s.session.post(s.url + 'ingest', data=params)
+    r = s.request('post', 'ingest', operation='admin', data=params)
     if r.status_code != 200:
         raise Exception('Action failed:\n{0}'.format(r.content))
-    print r.content
-    print r.url
+    _logger.debug(r.url)
     return
 
 
@@ -303,15 +1149,17 @@ def remove_named_graph(name, session=None):
     modelName:http://localhost/staged
     submit:Create Model
     modelType:sdb"""
-    s = Session()
-    s.login()
+    s = session or get_session()
     params = {
         'action': 'removeModel',
         'modelName': name,
         'submit': 'remove',
         'modelType': 'sdb',
     }
-    s.session.post(s.url + 'ingest', data=params)
+    s.request('post', 'ingest', operation='admin', data=params)
+    notify_change()
+    if s.ledger is not None:
+        s.ledger.forget(s.url, graph=name)
     return
 
 
@@ -320,44 +1168,48 @@ def clear_named_graph(name, session=None):
     modelName:http://localhost/staged
     modelType:sdb
     submit:clear statements"""
-    s = Session()
-    s.login()
+    s = session or get_session()
     params = {
         'action': 'clearModel',
         'modelName': name,
         'submit': 'clear statements',
         'modelType': 'sdb',
     }
-    s.session.post(s.url + 'ingest', data=params)
+    s.request('post', 'ingest', operation='admin', data=params)
+    notify_change()
+    if s.ledger is not None:
+        s.ledger.forget(s.url, graph=name)
     return
 
 
-def add_rdf_to_named_graph(file_path, model_name, format='N3'):
+def add_rdf_to_named_graph(file_path, model_name, format='N3', session=None):
     filename, extension = get_name_extension(file_path)
-    vs = Session()
-    vs.login()
-    base_url = vs.url
+    vs = session or get_session()
+    digest = None
+    if vs.ledger is not None:
+        digest = vs.ledger.file_hash(file_path, format)
+        skipped = vs.uploaded('add', digest, file_path, graph=model_name)
+        if skipped:
+            return skipped
     payload = dict(
         language=format,
         submit='Load Data',
         modelName=model_name,
         docLoc='',
     )
-    print payload
-    p = vs.session.post(
-        base_url + 'uploadRDF',
-        verify=False,
-        data=payload,
-        files={'filePath': (filename, open(file_path, 'rb'))}
-    )
-    print p.url
-    print p.status_code
-    print p.headers
-    if p.status_code != 200:
-        raise Exception('Error adding RDF.  Check Vivo log.\n%s' % p.content)
-    vs.logout()
-    return True
+    with open(file_path, 'rb') as f:
+        result = vs.post_upload(
+            file_path,
+            'add',
+            data=payload,
+            files={'filePath': (filename, f)}
+        )
+    vs.record_upload('add', digest, file_path, graph=model_name)
+    return result
+
 
+def print_progress(status):
+    print>>sys.stderr, status.describe()
 
 
 def main():
@@ -366,23 +1218,67 @@ def main():
     p.add_option('--format', default='N3', help="Format for the loaded or removed RDF.  Defaults to N3.")
     p.add_option('--uri1', help="Primary uri for merging.")
     p.add_option('--uri2', help="Secondary uri for merging.")
+    p.add_option('--pairs', help="CSV of uri1,uri2 pairs.  Used for merge-batch only.")
+    p.add_option('--workers', type='int', default=2, help="Concurrent requests for merge-batch.")
+    p.add_option('--ledger', help="SQLite file recording uploads.  Content already uploaded is skipped.")
+    p.add_option('--batch-size', type='int', default=BATCH_SIZE, help="Statements per request for bulk add and remove.  N-Triples only.")
+    p.add_option('--checkpoint', help="File recording acknowledged statements or merges.  Bulk loads and batch merges resume from it.")
+    p.add_option('--adaptive', action='store_true', help="Tune the bulk batch size from VIVO's response times, starting at --batch-size.")
+    p.add_option('--graph', help="Named graph to stage files in for staged-add.")
+    p.add_option('--wait', action='store_true', help="Wait for recompute and rebuild to finish, reporting progress.")
     config, arguments = p.parse_args()
 
     if len(arguments) == 0:
-        raise Exception("No action specified.  Options are recompute, rebuild, add, remove, merge.")
-
-    #Handle commands.
-    for arg in arguments:
-        if 'recompute' in arg:
-            recompute_inferences(config)
-        elif 'rebuild' in arg:
-            rebuild_index(config)
-        elif 'add' in arg:
-            add_rdf(config.file, format=config.format)
-        elif 'remove' in arg:
-            remove_rdf(config.file, format=config.format)
-        elif 'merge' in arg:
-            merge_individuals(config.uri1, config.uri2)
+        raise Exception("No action specified.  Options are recompute, rebuild, add, remove, bulk-add, bulk-remove, staged-add, merge, merge-batch.")
+
+    #Handle commands with one shared, logged-in session.
+    vs = get_session()
+    if config.ledger:
+        from ledger import UploadLedger
+        vs.ledger = UploadLedger(config.ledger)
+    try:
+        for arg in arguments:
+            if arg in ('bulk-add', 'bulk-remove'):
+                vs.bulk_load(
+                    config.file,
+                    mode=arg.split('-')[1],
+                    batch_size=config.batch_size,
+                    format='N-TRIPLE',
+                    checkpoint=config.checkpoint,
+                    adaptive=AdaptiveBatchSize(config.batch_size) if config.adaptive else None
+                )
+                print>>sys.stderr, vs.metrics.summary()
+            elif arg == 'staged-add':
+                from staging import STAGING_GRAPH, staged_load
+                report = staged_load(
+                    [config.file],
+                    session=vs,
+                    graph=config.graph or STAGING_GRAPH,
+                    format=config.format
+                )
+                print>>sys.stderr, report.summary()
+            elif arg == 'merge-batch':
+                report = merge_pairs(
+                    vs,
+                    read_pairs(config.pairs),
+                    workers=config.workers,
+                    checkpoint=config.checkpoint
+                )
+                print>>sys.stderr, report.summary()
+            elif 'recompute' in arg:
+                recompute_inferences(config, session=vs, wait=config.wait,
+                                     progress=print_progress)
+            elif 'rebuild' in arg:
+                rebuild_index(config, session=vs, wait=config.wait,
+                              progress=print_progress)
+            elif 'add' in arg:
+                add_rdf(config.file, format=config.format, session=vs)
+            elif 'remove' in arg:
+                remove_rdf(config.file, format=config.format, session=vs)
+            elif 'merge' in arg:
+                merge_individuals(config.uri1, config.uri2, session=vs)
+    finally:
+        close_sessions()
 
 if __name__ == "__main__":
     main()